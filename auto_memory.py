@@ -12,15 +12,30 @@ license: see extension documentation file `auto_memory.md` (License section) for
 """
 
 import asyncio
+import atexit
+import bisect
+import contextlib
+import copy
+import functools
+import hashlib
+import inspect
 import json
 import logging
+import os
 import re
+import sqlite3
 import threading
+import time
+import weakref
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime
 from typing import (
     Any,
     Awaitable,
     Callable,
+    Hashable,
     Literal,
     Optional,
     Type,
@@ -30,8 +45,10 @@ from typing import (
     overload,
 )
 
+import httpx
 from fastapi import HTTPException, Request
 from open_webui.main import app as webui_app
+from open_webui.models.memories import Memories
 from open_webui.models.users import UserModel, Users
 from open_webui.retrieval.vector.main import SearchResult
 from open_webui.routers.memories import (
@@ -43,12 +60,181 @@ from open_webui.routers.memories import (
     query_memory,
     update_memory_by_id,
 )
-from openai import BadRequestError, OpenAI
+
+try:
+    from open_webui.retrieval.vector.factory import VECTOR_DB_CLIENT
+except ImportError:  # Open WebUI < 0.6
+    from open_webui.retrieval.vector.connector import VECTOR_DB_CLIENT
+from openai import AsyncOpenAI, BadRequestError, DefaultAsyncHttpxClient
 from pydantic import BaseModel, Field, create_model
 
+try:
+    import tiktoken
+except ImportError:  # optional, token counts are estimated from characters
+    tiktoken = None
+
+try:
+    import numpy as np
+except ImportError:  # optional, the similarity cutoff falls back to a Python loop
+    np = None
+
 LogLevel = Literal["debug", "info", "warning", "error"]
 
+# Upper bound of cached AsyncOpenAI clients per event loop (one per api_url/api_key)
+MAX_CACHED_OPENAI_CLIENTS = 64
+
 STRINGIFIED_MESSAGE_TEMPLATE = "-{index}. {role}: ```{content}```"
+STRINGIFIED_CONTEXT_MESSAGE_TEMPLATE = (
+    "-{index}. {role} (already processed, shortened): ```{content}```"
+)
+
+# Memory context block that Open WebUI injects into the system prompt
+MEMORY_CONTEXT_PATTERN = re.compile(
+    r"<memory_user_context>\s*(\[[\s\S]*?\])\s*</memory_user_context>"
+)
+
+# Pre-filter heuristics: cheap local signals for whether a turn may contain durable
+# personal facts worth an LLM extraction call.
+MEMORY_REQUEST_PATTERN = re.compile(
+    r"\b(remember|forget|don'?t forget|note (that|this)|keep in mind|from now on|going forward)\b"
+    r"|记住|记得|忘记|忘掉|别忘|以后|从现在开始",
+    re.IGNORECASE,
+)
+TRIVIAL_TURN_PATTERN = re.compile(
+    r"^\W*(ok(ay)?|k|kk|thanks?( you| a lot| so much)?|thx|ty|cool|nice|great|awesome|perfect|"
+    r"got it|sure|yes|yeah|yep|no|nope|lol|lmao|haha+|hmm+|bye|hi|hello|hey|"
+    r"好的?|嗯+|哦+|谢谢(你|啦)?|多谢|感谢|哈+|收到|行|可以|对|是的?|没问题|明白了?|再见|你好)\W*$",
+    re.IGNORECASE,
+)
+FIRST_PERSON_PATTERN = re.compile(
+    r"\b(i|i'm|i've|i'd|i'll|im|me|my|mine|myself|we|our|us)\b|我|咱",
+    re.IGNORECASE,
+)
+PERSONAL_FACT_PATTERN = re.compile(
+    r"\b(like|love|hate|prefer|enjoy|favou?rite|dislike|allergic|work(ing)? (at|as|for)|"
+    r"live|moved|born|married|wife|husband|partner|kids?|son|daughter|dog|cat|pet|"
+    r"job|study|studying|school|university|hobby|goal|plan(ning)?|always|never|usually)\b"
+    r"|喜欢|讨厌|爱|偏好|工作|住在|搬|家人|老婆|老公|孩子|宠物|爱好|目标|计划|总是|从不|习惯",
+    re.IGNORECASE,
+)
+
+
+def message_text(message: dict[str, Any]) -> str:
+    """Text of a chat message. Multimodal (list) content keeps only its text parts."""
+    content = message.get("content", "")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(
+            part.get("text", "")
+            for part in content
+            if isinstance(part, dict) and part.get("type") == "text"
+        )
+    return str(content or "")
+
+
+@functools.lru_cache(maxsize=1)
+def _token_encoding() -> Optional[Any]:
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:  # e.g. the encoding can't be downloaded
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Token count of `text`: exact with tiktoken if it is installed, otherwise a fast
+    estimate of ~4 characters per token for ASCII and one token per other character.
+    """
+    encoding = _token_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (ascii_chars + 3) // 4 + len(text) - ascii_chars
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Shorten `text` to at most `max_tokens` tokens, omission marker included, keeping
+    its head and tail. Only the marker is left if even that doesn't fit.
+    """
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    keep_chars = len(text) * max_tokens // tokens
+    while True:
+        head = keep_chars * 2 // 3
+        tail = keep_chars - head
+        omitted = f" …[{tokens - max_tokens} tokens omitted]… "
+        shortened = (
+            text[:head].rstrip() + omitted + (text[-tail:].lstrip() if tail else "")
+        )
+        if keep_chars == 0 or estimate_tokens(shortened) <= max_tokens:
+            return shortened
+        keep_chars = keep_chars * 9 // 10
+
+
+def _memory_timestamp(value: Any) -> Optional[float]:
+    """Epoch seconds of a memory timestamp given as a number or an ISO 8601 string."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            return None
+    return None
+
+
+def memory_simhash(text: str) -> int:
+    """64-bit SimHash of a memory over the character trigrams of its normalized words."""
+    normalized = " ".join(re.findall(r"\w+", text.lower()))
+    shingles = {normalized[i : i + 3] for i in range(max(1, len(normalized) - 2))}
+    weights = [0] * 64
+    for shingle in shingles:
+        digest = hashlib.blake2b(shingle.encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, "big")
+        for bit in range(64):
+            weights[bit] += 1 if (value >> bit) & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def cluster_near_duplicates(fingerprints: list[int], max_distance: int) -> list[list[int]]:
+    """
+    Group the indexes of SimHash fingerprints that differ in at most `max_distance`
+    bits (transitively). Fingerprints are split into max_distance + 1 bands: two
+    near-duplicates always share at least one band exactly, so only pairs sharing a
+    band are compared instead of all pairs.
+    """
+    parent = list(range(len(fingerprints)))
+
+    def _find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    bands = min(max_distance, 63) + 1
+    edges = [64 * band // bands for band in range(bands + 1)]
+    for start, end in zip(edges, edges[1:]):
+        mask = (1 << (end - start)) - 1
+        buckets: dict[int, list[int]] = {}
+        for i, fingerprint in enumerate(fingerprints):
+            buckets.setdefault((fingerprint >> start) & mask, []).append(i)
+        for members in buckets.values():
+            for a_pos, a in enumerate(members):
+                for b in members[a_pos + 1 :]:
+                    if _find(a) != _find(b) and (
+                        bin(fingerprints[a] ^ fingerprints[b]).count("1") <= max_distance
+                    ):
+                        parent[_find(a)] = _find(b)
+
+    clusters: dict[int, list[int]] = {}
+    for i in range(len(fingerprints)):
+        clusters.setdefault(_find(i), []).append(i)
+    return [members for members in clusters.values() if len(members) > 1]
 
 
 UNIFIED_SYSTEM_PROMPT = """\
@@ -404,6 +590,18 @@ Output:
 </examples>\
 """
 
+COMPACTION_SYSTEM_PROMPT = """\
+You are compacting the Memories of a user - individual facts about the user collected over time. You are given clusters of near-duplicate memories: the same fact stated several times, or outdated and newer versions of the same fact. Each memory has an ID, its content and the time it was last updated.
+
+For each cluster:
+- Keep exactly one memory and update it with a single merged content that preserves every distinct detail of the cluster.
+- When memories contradict each other, the most recently updated one is correct.
+- Delete every other memory of the cluster.
+- If the memories of a cluster are not actually about the same fact, return no actions for that cluster.
+
+Only return update and delete actions for the given IDs. Never add memories.\
+"""
+
 
 async def emit_status(
     description: str,
@@ -469,20 +667,49 @@ class Memory(BaseModel):
     )
 
 
+_JSON_SCHEMA_CACHE: weakref.WeakKeyDictionary[type, dict[Hashable, dict]] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+class CachedSchemaModel(BaseModel):
+    """
+    BaseModel whose generated JSON schema is cached per class and arguments. The OpenAI
+    SDK regenerates the schema of `response_format` on every call (and mutates it), so a
+    copy of the cached schema is returned.
+    """
+
+    @classmethod
+    def model_json_schema(cls, *args: Any, **kwargs: Any) -> dict[str, Any]:
+        per_class = _JSON_SCHEMA_CACHE.setdefault(cls, {})
+        key = (args, tuple(sorted(kwargs.items())))
+        schema = per_class.get(key)
+        if schema is None:
+            schema = super().model_json_schema(*args, **kwargs)
+            per_class[key] = schema
+        return copy.deepcopy(schema)
+
+
 def build_actions_request_model(existing_ids: list[str]):
     """Dynamically build versions of the Update/Delete action models whose `id` fields
-    are Literal[...] constrained to the provided existing_ids. Returns a tuple:
+    are Literal[...] constrained to the provided existing_ids, wrapped in a request model.
 
-        (DynamicMemoryUpdateAction, DynamicMemoryDeleteAction, DynamicMemoryUpdateRequest)
+    If existing_ids is empty, only add actions are allowed, so that add-only flows still
+    parse.
 
-    If existing_ids is empty, we still return permissive forms (falls back to str) so that
-    add-only flows still parse.
+    Models are cached by the sorted set of IDs, so repeated plans over the same related
+    memories reuse the model and its JSON schema.
     """
+    return _build_actions_request_model(tuple(sorted(set(existing_ids))))
+
+
+@functools.lru_cache(maxsize=128)
+def _build_actions_request_model(existing_ids: tuple[str, ...]):
     if not existing_ids:
         # No IDs to constrain, so no relevant memories = can only create new memories
         allowed_actions = MemoryAddAction
     else:
-        id_literal_type = Literal[tuple(existing_ids)]
+        id_literal_type = Literal[existing_ids]
 
         DynamicMemoryUpdateAction = create_model(
             "MemoryUpdateAction",
@@ -510,67 +737,714 @@ def build_actions_request_model(existing_ids: list[str]):
                 max_length=20,
             ),
         ),
-        __base__=BaseModel,
+        __base__=CachedSchemaModel,
     )
 
 
-def searchresults_to_memories(results: SearchResult) -> list[Memory]:
-    memories = []
+class MemoryRecord:
+    """
+    Lightweight search hit, validated into a `Memory` only when it is serialized for
+    the prompt. Timestamps are kept as epoch seconds.
+    """
+
+    __slots__ = ("mem_id", "created_at", "updated_at", "content", "similarity_score")
+
+    def __init__(
+        self,
+        mem_id: str,
+        created_at: float,
+        updated_at: float,
+        content: str,
+        similarity_score: Optional[float],
+    ):
+        self.mem_id = mem_id
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.content = content
+        self.similarity_score = similarity_score
+
+    def to_memory(self) -> Memory:
+        return Memory(
+            mem_id=self.mem_id,
+            created_at=datetime.fromtimestamp(self.created_at),
+            update_at=datetime.fromtimestamp(self.updated_at),
+            content=self.content,
+            similarity_score=self.similarity_score,
+        )
 
+    def __repr__(self) -> str:
+        return f"MemoryRecord(mem_id={self.mem_id!r}, similarity_score={self.similarity_score}, content={self.content!r})"
+
+
+def _similarity_survivors(
+    distances: Optional[list[float]], count: int, min_similarity: Optional[float]
+) -> list[int]:
+    """Indexes of the hits whose (rounded) similarity reaches `min_similarity`."""
+    if min_similarity is None:
+        return list(range(count))
+    if not distances:
+        return []
+    # numpy only pays off once there are enough hits to amortize the array conversion
+    if np is not None and count >= 64:
+        scores = np.round(np.asarray(distances[:count], dtype=float), 3)
+        return np.flatnonzero(scores >= min_similarity).tolist()
+    return [
+        i for i, d in enumerate(distances[:count]) if round(d, 3) >= min_similarity
+    ]
+
+
+def searchresults_to_memory_batches(
+    results: SearchResult, min_similarity: Optional[float] = None
+) -> list[list[MemoryRecord]]:
+    """
+    Convert a SearchResult into one list of records per query. The similarity cutoff
+    is applied to the distances first, so only surviving hits are materialized.
+    """
     if not results.ids or not results.documents or not results.metadatas:
         raise ValueError("SearchResult must contain ids, documents, and metadatas")
 
+    batches: list[list[MemoryRecord]] = []
     for batch_idx, (ids_batch, docs_batch, metas_batch) in enumerate(
         zip(results.ids, results.documents, results.metadatas)
     ):
         distances_batch = results.distances[batch_idx] if results.distances else None
+        count = min(len(ids_batch), len(docs_batch), len(metas_batch))
 
-        for doc_idx, (mem_id, content, meta) in enumerate(
-            zip(ids_batch, docs_batch, metas_batch)
-        ):
+        records = []
+        for doc_idx in _similarity_survivors(distances_batch, count, min_similarity):
+            mem_id = ids_batch[doc_idx]
+            meta = metas_batch[doc_idx]
             if not meta:
                 raise ValueError(f"Missing metadata for memory id={mem_id}")
             if "created_at" not in meta:
                 raise ValueError(
                     f"Missing 'created_at' in metadata for memory id={mem_id}"
                 )
-            if "updated_at" not in meta:
-                # If updated_at is missing, default to created_at
-                meta["updated_at"] = meta["created_at"]
-
-            created_at = datetime.fromtimestamp(meta["created_at"])
-            updated_at = datetime.fromtimestamp(meta["updated_at"])
+            # If updated_at is missing, default to created_at
+            updated_at = meta.get("updated_at", meta["created_at"])
 
             # Extract similarity score if available
             similarity_score = None
             if distances_batch is not None and doc_idx < len(distances_batch):
                 similarity_score = round(distances_batch[doc_idx], 3)
 
-            mem = Memory(
-                mem_id=mem_id,
-                created_at=created_at,
-                update_at=updated_at,
-                content=content,
-                similarity_score=similarity_score,
+            records.append(
+                MemoryRecord(
+                    mem_id,
+                    meta["created_at"],
+                    updated_at,
+                    docs_batch[doc_idx],
+                    similarity_score,
+                )
+            )
+        batches.append(records)
+
+    return batches
+
+
+def fuse_memory_rankings(
+    rankings: list[list[MemoryRecord]], k: int, rrf_k: int = 60
+) -> list[MemoryRecord]:
+    """
+    Merge several ranked result lists with reciprocal rank fusion, deduplicated by
+    mem_id. A memory keeps its best similarity score across the lists.
+    """
+    scores: dict[str, float] = {}
+    best: dict[str, MemoryRecord] = {}
+    for ranking in rankings:
+        for rank, memory in enumerate(ranking):
+            scores[memory.mem_id] = scores.get(memory.mem_id, 0.0) + 1 / (
+                rrf_k + rank + 1
             )
-            memories.append(mem)
+            kept = best.get(memory.mem_id)
+            if kept is None or (memory.similarity_score or 0) > (
+                kept.similarity_score or 0
+            ):
+                best[memory.mem_id] = memory
+    fused = sorted(scores, key=lambda mem_id: scores[mem_id], reverse=True)
+    return [best[mem_id] for mem_id in fused[:k]]
+
+
+class EmbeddingUnavailableError(RuntimeError):
+    """Open WebUI's embedding function can't be used directly."""
+
 
-    return memories
+QueueFullPolicy = Literal["drop_oldest", "drop_newest"]
 
 
-def _run_detached(coro):
-    """Helper to run coroutine in detached thread"""
+@dataclass
+class _BackgroundJob:
+    factory: Callable[[], Awaitable[Any]]
+    key: Optional[Hashable] = None
+
+
+class _BackgroundWorker:
+    """
+    Long-lived background executor: one dedicated event loop thread, a bounded
+    asyncio queue and a fixed number of worker coroutines.
+
+    Jobs are submitted as zero-argument coroutine factories so that a dropped job
+    never creates a coroutine. A job whose key matches a job that is still queued
+    replaces it in place (coalesced), so only the latest state per key is processed.
+    Jobs submitted with a `delay` are debounced: they wait for a quiet window, and
+    every new submission for the same key restarts the window and supersedes the
+    waiting job.
+
+    When the queue is full, submit() waits up to `enqueue_timeout` seconds for space
+    (backpressure), then `full_policy` decides whether the oldest queued job or the new
+    one is dropped.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        queue_size: int,
+        full_policy: QueueFullPolicy,
+        enqueue_timeout: float,
+        log: Callable[..., None],
+    ):
+        self.config = (workers, queue_size, full_policy, enqueue_timeout)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.full_policy = full_policy
+        self.enqueue_timeout = enqueue_timeout
+        self.log = log
+        self.stats = {
+            "submitted": 0,
+            "debounced": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "completed": 0,
+            "failed": 0,
+        }
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue[_BackgroundJob]] = None
+        self._queued_by_key: dict[Hashable, _BackgroundJob] = {}
+        self._debounced: dict[Hashable, tuple[asyncio.TimerHandle, _BackgroundJob]] = {}
+        self._release_tasks: set[asyncio.Task] = set()
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._closing = False
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="auto-memory-worker", daemon=True
+            )
+            self._thread.start()
+        self._ready.wait()
 
-    def _runner():
+    def _run(self) -> None:
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        tasks = [loop.create_task(self._work()) for _ in range(self.workers)]
+        self._ready.set()
         try:
-            loop.run_until_complete(coro)
+            loop.run_forever()
         finally:
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
             loop.close()
 
-    thread = threading.Thread(target=_runner, daemon=True)
-    thread.start()
+    @property
+    def backlog(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(
+        self,
+        factory: Callable[[], Awaitable[Any]],
+        key: Optional[Hashable] = None,
+        delay: float = 0.0,
+    ) -> bool:
+        """
+        Queue a job from any event loop. Returns False if the job was dropped.
+
+        With `delay` > 0 and a key, the job is queued only after `delay` seconds
+        without another submission for the same key.
+        """
+        if self._closing:
+            self.log("background worker is shutting down, job rejected", level="warning")
+            return False
+        self.start()
+        assert self._loop is not None
+        job = _BackgroundJob(factory=factory, key=key)
+        if delay > 0 and key is not None:
+            self._loop.call_soon_threadsafe(self._debounce, job, delay)
+            return True
+        future = asyncio.run_coroutine_threadsafe(self._enqueue(job), self._loop)
+        return await asyncio.wrap_future(future)
+
+    def _debounce(self, job: _BackgroundJob, delay: float) -> None:
+        assert self._loop is not None
+        previous = self._debounced.pop(job.key, None)
+        if previous is not None:
+            previous[0].cancel()
+            self.stats["debounced"] += 1
+            self.log(
+                f"superseded pending job within quiet window. key={job.key}",
+                level="debug",
+            )
+        handle = self._loop.call_later(delay, self._release, job)
+        self._debounced[job.key] = (handle, job)
+
+    def _release(self, job: _BackgroundJob) -> None:
+        assert self._loop is not None
+        if self._debounced.get(job.key, (None, None))[1] is job:
+            del self._debounced[job.key]
+        task = self._loop.create_task(self._enqueue(job))
+        self._release_tasks.add(task)
+        task.add_done_callback(self._release_tasks.discard)
+
+    async def _enqueue(self, job: _BackgroundJob) -> bool:
+        assert self._queue is not None
+        self.stats["submitted"] += 1
+
+        pending = self._queued_by_key.get(job.key) if job.key is not None else None
+        if pending is not None:
+            pending.factory = job.factory
+            self.stats["coalesced"] += 1
+            self.log(f"coalesced job into queued one. key={job.key}", level="debug")
+            return True
+
+        queued = self._try_put(job)
+        if not queued and self.enqueue_timeout > 0:
+            try:
+                await asyncio.wait_for(
+                    self._queue.put(job), timeout=self.enqueue_timeout
+                )
+                queued = True
+            except asyncio.TimeoutError:
+                queued = self._try_put(job)
+
+        if not queued:
+            if self.full_policy == "drop_newest":
+                self.stats["dropped"] += 1
+                self.log(
+                    f"background queue full ({self.queue_size}), dropped new job. key={job.key}",
+                    level="warning",
+                )
+                return False
+
+            oldest = self._queue.get_nowait()
+            self._queue.task_done()
+            self._forget(oldest)
+            self.stats["dropped"] += 1
+            self.log(
+                f"background queue full ({self.queue_size}), dropped oldest job. key={oldest.key}",
+                level="warning",
+            )
+            self._queue.put_nowait(job)
+
+        if job.key is not None:
+            self._queued_by_key[job.key] = job
+        self.log(
+            f"background job queued. backlog={self._queue.qsize()}/{self.queue_size}",
+            level="debug",
+        )
+        return True
+
+    def _try_put(self, job: _BackgroundJob) -> bool:
+        assert self._queue is not None
+        try:
+            self._queue.put_nowait(job)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def _forget(self, job: _BackgroundJob) -> None:
+        if job.key is not None and self._queued_by_key.get(job.key) is job:
+            del self._queued_by_key[job.key]
+
+    async def _work(self) -> None:
+        assert self._queue is not None
+        while True:
+            job = await self._queue.get()
+            try:
+                self._forget(job)
+                await job.factory()
+                self.stats["completed"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                self.log(f"background job failed: {e}", level="error")
+            finally:
+                self._queue.task_done()
+
+    async def _drain(self) -> None:
+        assert self._queue is not None
+        # Don't wait out quiet windows on shutdown; run debounced jobs right away
+        for handle, job in list(self._debounced.values()):
+            handle.cancel()
+            await self._enqueue(job)
+        self._debounced.clear()
+        await self._queue.join()
+
+    def shutdown(self, timeout: Optional[float] = 30.0) -> None:
+        """Stop accepting jobs, wait for queued jobs to finish, then stop the loop."""
+        self._closing = True
+        loop, thread = self._loop, self._thread
+        if loop is None or thread is None or loop.is_closed():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._drain(), loop).result(timeout)
+        except Exception as e:
+            self.log(
+                f"background worker did not drain in time, {self.backlog} jobs abandoned: {e}",
+                level="warning",
+            )
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
+
+
+class _StateStore:
+    """
+    Small JSON key/value store: a bounded in-memory LRU, optionally persisted to a
+    SQLite file so state survives restarts. Thread-safe.
+    """
+
+    def __init__(self, namespace: str, path: str = "", max_entries: int = 10000):
+        self.namespace = namespace
+        self.path = path
+        self.max_entries = max_entries
+        self._cache: OrderedDict[str, Any] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS auto_memory_state "
+                "(namespace TEXT, key TEXT, value TEXT, PRIMARY KEY (namespace, key))"
+            )
+            self._db.commit()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                "SELECT value FROM auto_memory_state WHERE namespace = ? AND key = ?",
+                (self.namespace, key),
+            ).fetchone()
+            if row is None:
+                return None
+            value = json.loads(row[0])
+            self._remember(key, value)
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._remember(key, value)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO auto_memory_state VALUES (?, ?, ?)",
+                    (self.namespace, key, json.dumps(value)),
+                )
+                self._db.commit()
+
+    def _remember(self, key: str, value: Any) -> None:
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+
+class _TTLCache:
+    """Bounded LRU cache whose entries also expire after `ttl` seconds. Thread-safe."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Drop all entries whose key matches `predicate`. Returns the number dropped."""
+        with self._lock:
+            stale = [key for key in self._entries if predicate(key)]
+            for key in stale:
+                del self._entries[key]
+            return len(stale)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+class _EmbeddingCache:
+    """
+    Content-hash keyed LRU cache of embedding vectors with a memory ceiling.
+
+    Vectors are kept as float32 arrays. When `spill_path` is set, entries evicted from
+    memory are written to a SQLite file and promoted back into memory on a later hit.
+    Thread-safe.
+    """
+
+    def __init__(self, max_bytes: int, spill_path: str = ""):
+        self.max_bytes = max_bytes
+        self.spill_path = spill_path
+        self.hits = 0
+        self.misses = 0
+        self.spill_hits = 0
+        self._entries: OrderedDict[str, array] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if spill_path:
+            self._db = sqlite3.connect(spill_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS auto_memory_embeddings "
+                "(key TEXT PRIMARY KEY, vector BLOB)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def key_for(text: str, model: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[list[float]]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector.tolist()
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT vector FROM auto_memory_embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    vector = array("f")
+                    vector.frombytes(row[0])
+                    self._store(key, vector)
+                    self.spill_hits += 1
+                    return vector.tolist()
+            self.misses += 1
+            return None
+
+    def set(self, key: str, vector: list[float]) -> None:
+        with self._lock:
+            self._store(key, array("f", vector))
+
+    def _store(self, key: str, vector: array) -> None:
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= previous.itemsize * len(previous)
+        self._entries[key] = vector
+        self._bytes += vector.itemsize * len(vector)
+
+        spilled = []
+        while self._bytes > self.max_bytes and self._entries:
+            old_key, old_vector = self._entries.popitem(last=False)
+            self._bytes -= old_vector.itemsize * len(old_vector)
+            spilled.append((old_key, old_vector.tobytes()))
+        if spilled and self._db is not None:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO auto_memory_embeddings VALUES (?, ?)", spilled
+            )
+            self._db.commit()
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "spill_hits": self.spill_hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+
+MetricSeries = dict[tuple[tuple[str, str], ...], float]
+
+_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Metrics:
+    """
+    In-process metrics of the extraction pipeline: a duration histogram per stage and
+    labelled counters, rendered in the Prometheus text exposition format. If `sink` is
+    set, it also receives every observation as (name, value, labels), e.g. to forward
+    it to StatsD. Thread-safe.
+    """
+
+    PREFIX = "auto_memory"
+    COUNTER_HELP = {
+        "runs_total": "Extraction runs by outcome.",
+        "llm_requests_total": "LLM requests by mode (structured, json_fallback or text).",
+        "actions_total": "Memory actions by type and outcome.",
+        "stage_failures_total": "Pipeline stages that raised an error.",
+        "compaction_runs_total": "Memory compaction runs by mode (dry_run or applied).",
+    }
+
+    def __init__(self, log: Callable[..., None]):
+        self.log = log
+        self.sink: Optional[Callable[[str, float, dict[str, str]], None]] = None
+        self._counters: dict[str, MetricSeries] = {}
+        # stage -> [count per bucket (last one is +Inf), sum, count]
+        self._histograms: dict[str, list[Any]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + amount
+        self._emit(name, amount, labels)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = [[0] * (len(_DURATION_BUCKETS) + 1), 0.0, 0]
+                self._histograms[stage] = histogram
+            histogram[0][bisect.bisect_left(_DURATION_BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+        self._emit("stage_duration_seconds", seconds, {"stage": stage})
+
+    @contextlib.contextmanager
+    def span(self, stage: str):
+        """Time a pipeline stage; a stage that raises is also counted as failed."""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc("stage_failures_total", stage=stage)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def _emit(self, name: str, value: float, labels: dict[str, str]) -> None:
+        if self.sink is None:
+            return
+        try:
+            self.sink(f"{self.PREFIX}_{name}", value, labels)
+        except Exception as e:
+            self.log(f"metrics sink failed: {e}", level="warning")
+
+    @staticmethod
+    def _labels(labels: tuple[tuple[str, str], ...]) -> str:
+        if not labels:
+            return ""
+        pairs = []
+        for name, value in labels:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+            value = value.replace("\n", "\\n")
+            pairs.append(f'{name}="{value}"')
+        return "{" + ",".join(pairs) + "}"
+
+    @staticmethod
+    def _value(value: float) -> str:
+        value = float(value)
+        return str(int(value)) if value.is_integer() else repr(value)
+
+    @classmethod
+    def format_family(
+        cls, name: str, kind: str, help_text: str, series: MetricSeries
+    ) -> list[str]:
+        full_name = f"{cls.PREFIX}_{name}"
+        lines = [f"# HELP {full_name} {help_text}", f"# TYPE {full_name} {kind}"]
+        for labels, value in sorted(series.items()):
+            lines.append(f"{full_name}{cls._labels(labels)} {cls._value(value)}")
+        return lines
+
+    def render(
+        self, extra: Optional[list[tuple[str, str, str, MetricSeries]]] = None
+    ) -> str:
+        """Render all metrics (plus `extra` (name, type, help, series) families)."""
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {
+                stage: (list(h[0]), h[1], h[2]) for stage, h in self._histograms.items()
+            }
+
+        lines: list[str] = []
+        if histograms:
+            full_name = f"{self.PREFIX}_stage_duration_seconds"
+            lines += [
+                f"# HELP {full_name} Time spent in each stage of the memory pipeline.",
+                f"# TYPE {full_name} histogram",
+            ]
+            for stage, (buckets, total, count) in sorted(histograms.items()):
+                cumulative = 0
+                for bound, bucket in zip(_DURATION_BUCKETS + (float("inf"),), buckets):
+                    cumulative += bucket
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    labels = self._labels((("stage", stage), ("le", le)))
+                    lines.append(f"{full_name}_bucket{labels} {cumulative}")
+                labels = self._labels((("stage", stage),))
+                lines.append(f"{full_name}_sum{labels} {self._value(total)}")
+                lines.append(f"{full_name}_count{labels} {count}")
+        for name, series in sorted(counters.items()):
+            help_text = self.COUNTER_HELP.get(name, name.replace("_", " ") + ".")
+            lines += self.format_family(name, "counter", help_text, series)
+        for name, kind, help_text, series in extra or []:
+            lines += self.format_family(name, kind, help_text, series)
+        return "\n".join(lines) + "\n"
+
+
+def messages_digest(messages: list[dict[str, Any]]) -> str:
+    """Stable content hash of a list of chat messages (role + content)."""
+    digest = hashlib.sha256()
+    for message in messages:
+        digest.update(
+            json.dumps(
+                [message.get("role"), message.get("content")],
+                ensure_ascii=False,
+                default=str,
+            ).encode()
+        )
+    return digest.hexdigest()
+
+
+@dataclass
+class MemoryRunContext:
+    """
+    Per-invocation state for one outlet call. Passed explicitly through the extraction
+    flow instead of being stored on the shared Filter instance, so concurrent
+    extractions for different users never see each other's valves.
+    """
+
+    user: UserModel
+    current_user: dict[str, Any]
+    user_valves: "Filter.UserValves"
+    chat_id: str = ""
+
+    @property
+    def user_has_own_key(self) -> bool:
+        return bool(self.user_valves.api_key and self.user_valves.api_key.strip())
 
 
 R = TypeVar("R", bound=BaseModel)
@@ -590,14 +1464,53 @@ class Filter:
         api_key: str = Field(
             default="", description="API key for OpenAI compatible endpoint"
         )
+        max_connections: int = Field(
+            default=20,
+            ge=1,
+            description="maximum number of concurrent HTTP connections in the shared pool used for LLM requests",
+        )
+        max_keepalive_connections: int = Field(
+            default=10,
+            ge=0,
+            description="maximum number of idle keep-alive connections kept in the shared pool",
+        )
+        keepalive_expiry: float = Field(
+            default=30.0,
+            ge=0.0,
+            description="seconds an idle keep-alive connection is kept open before being closed",
+        )
+        structured_output_recheck_interval: float = Field(
+            default=3600.0,
+            ge=0.0,
+            description="seconds an endpoint/model that rejected structured outputs is sent schema-instructed JSON requests directly, before structured outputs are tried again. 0 tries structured outputs on every request.",
+        )
         messages_to_consider: int = Field(
             default=4,
             description="global default number of recent messages to consider for memory extraction (user override can supply a different value).",
         )
+        conversation_token_budget: int = Field(
+            default=0,
+            ge=0,
+            description="token budget for the conversation snippet sent to the LLM. messages are added newest first until the budget is used up (at most messages_to_consider). 0 disables the budget.",
+        )
+        max_message_tokens: int = Field(
+            default=1000,
+            ge=16,
+            description="with a conversation token budget, longer messages are shortened to this many tokens, keeping their beginning and end",
+        )
         related_memories_n: int = Field(
             default=5,
             description="number of related memories to consider when updating memories",
         )
+        multi_query_retrieval: bool = Field(
+            default=False,
+            description="search related memories with several focused queries (the combined recent messages, the user message alone and its most personal sentences) embedded in one batch and searched at once, merging the results by reciprocal rank fusion. improves recall when long replies dilute the combined query.",
+        )
+        memory_subqueries_n: int = Field(
+            default=3,
+            ge=1,
+            description="with multi-query retrieval, maximum number of focused queries in addition to the combined one",
+        )
         minimum_memory_similarity: Optional[float] = Field(
             default=None,
             ge=0.0,
@@ -608,10 +1521,151 @@ class Filter:
             default=False,
             description="SECURITY WARNING: allow users to override API URL/model without providing their own API key. this could allow users to steal your API key or use expensive models at your expense. only enable if you trust all users.",
         )
+        incremental_extraction: bool = Field(
+            default=True,
+            description="remember which messages of each chat were already analyzed. only new messages are sent in full (older ones are shortened as context), and the LLM call is skipped when there is no new user message (e.g. regenerated replies).",
+        )
+        context_snippet_chars: int = Field(
+            default=200,
+            ge=0,
+            description="with incremental extraction, already analyzed messages in the window are shortened to this many characters",
+        )
+        prefilter_enabled: bool = Field(
+            default=True,
+            description="skip the LLM extraction call for turns that cheap local checks rule out (see prefilter_mode)",
+        )
+        prefilter_mode: Literal["trivial", "heuristic"] = Field(
+            default="trivial",
+            description="'trivial' only skips trivial turns (e.g. 'thanks', 'ok'). 'heuristic' also scores turns by first-person and personal-fact keywords and length, and skips those below prefilter_threshold; this saves more LLM calls but can miss short or non-English facts.",
+        )
+        prefilter_threshold: float = Field(
+            default=0.3,
+            ge=0.0,
+            le=1.0,
+            description="minimum pre-filter score (0 to 1) for a turn to be sent to the LLM",
+        )
+        prefilter_extra_patterns: str = Field(
+            default="",
+            description="additional regular expressions (one per line) that always send a matching user message to the LLM",
+        )
+        related_memories_cache_size: int = Field(
+            default=256,
+            ge=0,
+            description="number of related-memory query results to cache. cached results for a user are dropped whenever their memories change. 0 disables the cache.",
+        )
+        related_memories_cache_ttl: float = Field(
+            default=300.0,
+            ge=0.0,
+            description="seconds a cached related-memory query result stays valid",
+        )
+        embedding_cache_max_mb: float = Field(
+            default=16.0,
+            ge=0.0,
+            description="memory ceiling (MB) of the embedding cache, which lets repeated texts (memory queries, memory contents) skip the embedding model. 0 disables the cache.",
+        )
+        embedding_cache_spill_path: str = Field(
+            default="",
+            description="optional SQLite file that embeddings evicted from the in-memory cache are spilled to. empty discards evicted embeddings.",
+        )
+        state_db_path: str = Field(
+            default="",
+            description="optional SQLite file used to persist extraction state (e.g. per-chat watermarks) across restarts. empty keeps state in memory only.",
+        )
         override_memory_context: bool = Field(
             default=False,
             description="intercept and override memory context injection in system prompts. when enabled, allows customization of how memories are presented to the model.",
         )
+        memory_context_format: Literal["json", "compact"] = Field(
+            default="json",
+            description="format of the overridden memory context. 'json' lists all memories as JSON; 'compact' ranks them by similarity and recency, drops near-duplicates and emits one '- [date] content' line per memory.",
+        )
+        memory_context_token_budget: int = Field(
+            default=0,
+            ge=0,
+            description="in compact format, maximum tokens of the memory context block; the lowest ranked memories are left out. 0 disables the cap.",
+        )
+        memory_context_recency_weight: float = Field(
+            default=0.2,
+            ge=0.0,
+            le=1.0,
+            description="in compact format, weight of recency (vs. similarity) when ranking memories",
+        )
+        memory_context_dedupe_threshold: float = Field(
+            default=0.9,
+            ge=0.0,
+            le=1.0,
+            description="in compact format, memories whose word overlap (Jaccard) with a higher ranked memory reaches this are dropped. 1 only drops exact duplicates.",
+        )
+        action_concurrency: int = Field(
+            default=4,
+            ge=1,
+            description="maximum number of memory actions of the same type (delete/update/add) applied concurrently",
+        )
+        batch_embeddings: bool = Field(
+            default=True,
+            description="embed the contents of all add/update actions of a plan in a single embedding call instead of one call per action. falls back to per-action requests if batching fails.",
+        )
+        background_workers: int = Field(
+            default=4,
+            ge=1,
+            description="number of concurrent background memory extraction jobs",
+        )
+        background_queue_size: int = Field(
+            default=64,
+            ge=1,
+            description="maximum number of memory extraction jobs waiting in the background queue",
+        )
+        background_queue_full_policy: QueueFullPolicy = Field(
+            default="drop_oldest",
+            description="what to drop when the background queue is full and the job can't be coalesced with a pending job for the same chat",
+        )
+        debounce_seconds: float = Field(
+            default=0.0,
+            ge=0.0,
+            description="quiet window per chat: extraction starts only after this many seconds without a new reply in the same chat, and only the latest conversation state is processed. 0 disables debouncing.",
+        )
+        background_enqueue_timeout: float = Field(
+            default=0.5,
+            ge=0.0,
+            description="seconds to wait for queue space before applying the queue full policy",
+        )
+        compaction_enabled: bool = Field(
+            default=False,
+            description="periodically scan each user's memories in the background for near-duplicate and outdated entries and merge them",
+        )
+        compaction_dry_run: bool = Field(
+            default=True,
+            description="only log (and store) a report of what compaction would merge, without changing any memory",
+        )
+        compaction_merge: Literal["rules", "llm"] = Field(
+            default="rules",
+            description="how near-duplicate clusters are merged. 'rules' keeps the most recently updated memory of each cluster and deletes the rest; 'llm' merges each cluster into one memory with a single batched LLM call.",
+        )
+        compaction_interval_hours: float = Field(
+            default=24.0,
+            ge=0.0,
+            description="minimum hours between two compaction runs for the same user",
+        )
+        compaction_max_distance: int = Field(
+            default=6,
+            ge=0,
+            le=16,
+            description="maximum number of differing SimHash bits (out of 64) for two memories to count as near-duplicates. higher values merge more aggressively.",
+        )
+        compaction_max_clusters: int = Field(
+            default=10,
+            ge=1,
+            description="maximum number of near-duplicate clusters merged per compaction run",
+        )
+        metrics_textfile_path: str = Field(
+            default="",
+            description="optional file the pipeline metrics (stage timings, action/LLM/failure counters, queue and cache stats) are written to in Prometheus text format, e.g. for the node_exporter textfile collector. empty disables the export.",
+        )
+        metrics_export_interval: float = Field(
+            default=15.0,
+            ge=0.0,
+            description="minimum seconds between two writes of the metrics file",
+        )
         debug_mode: bool = Field(
             default=False,
             description="enable debug logging",
@@ -650,15 +1704,28 @@ class Filter:
         logger = logging.getLogger()
         getattr(logger, level, logger.info)(message)
 
-    def messages_to_string(self, messages: list[dict[str, Any]]) -> str:
+    def messages_to_string(
+        self,
+        messages: list[dict[str, Any]],
+        ctx: MemoryRunContext,
+        processed_count: int = 0,
+    ) -> str:
+        """
+        Stringify the most recent messages for the extraction prompt. The first
+        `processed_count` messages were already analyzed in a previous run; they are
+        only shortened to `context_snippet_chars` to give context.
+
+        With `conversation_token_budget`, messages are added newest first until the
+        budget is used up, and long messages are cut in the middle. Only the text
+        parts of multimodal messages are included.
+        """
         stringified_messages: list[str] = []
 
         effective_messages_to_consider = self.get_restricted_user_valve(
-            user_valve_value=self.user_valves.messages_to_consider,
+            ctx=ctx,
+            user_valve_value=ctx.user_valves.messages_to_consider,
             admin_fallback=self.valves.messages_to_consider,
-            authorization_check=bool(
-                self.user_valves.api_key and self.user_valves.api_key.strip()
-            ),
+            authorization_check=ctx.user_has_own_key,
             valve_name="messages_to_consider",
         )
 
@@ -667,18 +1734,68 @@ class Filter:
             level="debug",
         )
 
+        token_budget = self.valves.conversation_token_budget
+        remaining_tokens = token_budget
+        last_user_idx = self._last_user_message_index(messages)
+        # Room kept for the latest user message's line (the turn the extraction acts
+        # on) while newer messages, such as the assistant reply, are added
+        reserved_tokens = 0
+        if token_budget and last_user_idx >= 0:
+            user_template = (
+                STRINGIFIED_CONTEXT_MESSAGE_TEMPLATE
+                if last_user_idx < processed_count
+                else STRINGIFIED_MESSAGE_TEMPLATE
+            )
+            user_line = functools.partial(
+                user_template.format,
+                index=len(messages) - last_user_idx,
+                role=messages[last_user_idx].get("role", "user"),
+            )
+            reserved_tokens = min(
+                self.valves.max_message_tokens + estimate_tokens(user_line(content="")),
+                estimate_tokens(user_line(content=message_text(messages[last_user_idx]))),
+                token_budget // 2,
+            )
         for i in range(1, effective_messages_to_consider + 1):
             if i > len(messages):
                 break
             try:
                 message = messages[-i]
-                stringified_messages.append(
-                    STRINGIFIED_MESSAGE_TEMPLATE.format(
-                        index=i,
-                        role=message.get("role", "user"),
-                        content=message.get("content", ""),
+                content = message_text(message)
+                template = STRINGIFIED_MESSAGE_TEMPLATE
+                if len(messages) - i < processed_count:
+                    template = STRINGIFIED_CONTEXT_MESSAGE_TEMPLATE
+                    limit = self.valves.context_snippet_chars
+                    if len(content) > limit:
+                        content = content[:limit].rstrip() + "…"
+                role = message.get("role", "user")
+                if token_budget:
+                    message_idx = len(messages) - i
+                    if message_idx <= last_user_idx:
+                        reserved_tokens = 0
+                    # The newest and the latest user message are always kept
+                    required = i == 1 or message_idx == last_user_idx
+                    overhead = estimate_tokens(
+                        template.format(index=i, role=role, content="")
                     )
-                )
+                    available = min(
+                        self.valves.max_message_tokens,
+                        remaining_tokens - reserved_tokens - overhead,
+                    )
+                    if available < 1 and not required:
+                        if message_idx > last_user_idx:
+                            # Skip, but keep going to reach the latest user message
+                            continue
+                        self.log(
+                            f"conversation token budget used up after {i - 1} messages",
+                            level="debug",
+                        )
+                        break
+                    content = truncate_to_tokens(content, max(1, available))
+                line = template.format(index=i, role=role, content=content)
+                if token_budget:
+                    remaining_tokens -= estimate_tokens(line)
+                stringified_messages.append(line)
             except Exception as e:
                 self.log(f"error stringifying message {i}: {e}", level="warning")
 
@@ -687,6 +1804,7 @@ class Filter:
     @overload
     async def query_openai_sdk(
         self,
+        ctx: MemoryRunContext,
         system_prompt: str,
         user_message: str,
         response_model: Type[R],
@@ -695,6 +1813,7 @@ class Filter:
     @overload
     async def query_openai_sdk(
         self,
+        ctx: MemoryRunContext,
         system_prompt: str,
         user_message: str,
         response_model: None = None,
@@ -702,6 +1821,7 @@ class Filter:
 
     async def query_openai_sdk(
         self,
+        ctx: MemoryRunContext,
         system_prompt: str,
         user_message: str,
         response_model: Optional[Type[R]] = None,
@@ -713,29 +1833,29 @@ class Filter:
         - If structured outputs are rejected as unsupported (Bad Request), falls back to a
           normal completion that is explicitly instructed (with a JSON Schema) to return
           valid JSON matching the schema, then parses the JSON (stripping ```json fences).
+        - Endpoints (api_url, model) that needed the fallback are remembered for
+          `structured_output_recheck_interval` seconds and use it directly.
         - If `response_model` is provided, this function returns a validated model instance
           or raises (it never returns a raw string in that case).
         - If `response_model` is not provided, returns raw text.
         """
 
-        user_has_own_key = bool(
-            self.user_valves.api_key and self.user_valves.api_key.strip()
-        )
-
         api_url = self.get_restricted_user_valve(
-            user_valve_value=self.user_valves.openai_api_url,
+            ctx=ctx,
+            user_valve_value=ctx.user_valves.openai_api_url,
             admin_fallback=self.valves.openai_api_url,
-            authorization_check=user_has_own_key,
+            authorization_check=ctx.user_has_own_key,
             valve_name="openai_api_url",
         ).rstrip("/")
 
         model_name = self.get_restricted_user_valve(
-            user_valve_value=self.user_valves.model,
+            ctx=ctx,
+            user_valve_value=ctx.user_valves.model,
             admin_fallback=self.valves.model,
-            authorization_check=user_has_own_key,
+            authorization_check=ctx.user_has_own_key,
             valve_name="model",
         )
-        api_key = self.user_valves.api_key or self.valves.api_key
+        api_key = ctx.user_valves.api_key or self.valves.api_key
 
         if "gpt-5" in model_name:
             temperature = 1.0
@@ -744,7 +1864,7 @@ class Filter:
             temperature = 0.3
             extra_args = {}
 
-        client = OpenAI(api_key=api_key, base_url=api_url)
+        client = self.get_openai_client(api_url=api_url, api_key=api_key)
         messages: list[dict[str, str]] = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_message},
@@ -782,12 +1902,14 @@ class Filter:
             )
 
         if response_model is None:
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=messages,  # type: ignore[arg-type]
-                temperature=temperature,
-                **extra_args,  # pyright: ignore[reportArgumentType]
-            )
+            self.metrics.inc("llm_requests_total", mode="text")
+            with self.metrics.span("llm_text"):
+                response = await client.chat.completions.create(
+                    model=model_name,
+                    messages=messages,  # type: ignore[arg-type]
+                    temperature=temperature,
+                    **extra_args,  # pyright: ignore[reportArgumentType]
+                )
             self.log(f"sdk response: {response}", level="debug")
 
             text_response = response.choices[0].message.content
@@ -797,19 +1919,57 @@ class Filter:
             return text_response
 
         response_model = cast(Type[R], response_model)
+
+        async def _query_schema_instructed_json() -> R:
+            fallback_messages: list[dict[str, str]] = [
+                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": _schema_instructions_for(response_model)},
+                {"role": "user", "content": user_message},
+            ]
+
+            self.metrics.inc("llm_requests_total", mode="json_fallback")
+            with self.metrics.span("llm_json_fallback"):
+                response = await client.chat.completions.create(
+                    model=model_name,
+                    messages=fallback_messages,  # type: ignore[arg-type]
+                    temperature=temperature,
+                    **extra_args,  # pyright: ignore[reportArgumentType]
+                )
+
+            text_response = response.choices[0].message.content
+            if text_response is None:
+                raise ValueError(f"no text response from LLM. message={text_response}")
+
+            cleaned = _strip_json_fences(text_response)
+            return response_model.model_validate_json(cleaned)
+
+        # Endpoints known to reject structured outputs go straight to JSON mode until
+        # the entry expires and structured outputs are tried again
+        capabilities = self._structured_output_support
+        capabilities.ttl = self.valves.structured_output_recheck_interval
+        capability_key = (api_url, model_name)
+        if capabilities.get(capability_key) is False:
+            self.log(
+                f"structured outputs known to be unsupported by {api_url} ({model_name}); using schema-instructed JSON",
+                level="debug",
+            )
+            return await _query_schema_instructed_json()
+
         self.log(
             f"attempting structured outputs with {response_model.__name__}",
             level="debug",
         )
 
         try:
-            response = client.chat.completions.parse(
-                model=model_name,
-                messages=messages,  # type: ignore[arg-type]
-                temperature=temperature,
-                response_format=response_model,
-                **extra_args,  # pyright: ignore[reportArgumentType]
-            )
+            self.metrics.inc("llm_requests_total", mode="structured")
+            with self.metrics.span("llm_structured"):
+                response = await client.chat.completions.parse(
+                    model=model_name,
+                    messages=messages,  # type: ignore[arg-type]
+                    temperature=temperature,
+                    response_format=response_model,
+                    **extra_args,  # pyright: ignore[reportArgumentType]
+                )
 
             message = response.choices[0].message
             if message.parsed is None:
@@ -817,6 +1977,7 @@ class Filter:
                     f"unable to parse structured response. message={message}"
                 )
 
+            capabilities.set(capability_key, True)
             return cast(R, message.parsed)
 
         except BadRequestError as e:
@@ -825,57 +1986,193 @@ class Filter:
                 level="warning",
             )
 
-            fallback_messages: list[dict[str, str]] = [
-                {"role": "system", "content": system_prompt},
-                {"role": "system", "content": _schema_instructions_for(response_model)},
-                {"role": "user", "content": user_message},
-            ]
-
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=fallback_messages,  # type: ignore[arg-type]
-                temperature=temperature,
-                **extra_args,  # pyright: ignore[reportArgumentType]
-            )
-
-            text_response = response.choices[0].message.content
-            if text_response is None:
-                raise ValueError(f"no text response from LLM. message={text_response}")
-
-            cleaned = _strip_json_fences(text_response)
-            return response_model.model_validate_json(cleaned)
+            result = await _query_schema_instructed_json()
+            # Only remember the endpoint as unsupported once JSON mode worked, so a bad
+            # request for another reason doesn't pin the endpoint to JSON mode
+            capabilities.set(capability_key, False)
+            return result
 
     def __init__(self):
         self.valves = self.Valves()
+        # event loop -> {"limits", "http_client", "clients"}; httpx pools can't be
+        # shared across event loops, so each loop gets its own pool.
+        self._openai_pools: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, dict[str, Any]
+        ] = weakref.WeakKeyDictionary()
+        self._openai_pools_lock = threading.Lock()
+        self._pool_close_tasks: set[asyncio.Task] = set()
+        # Whether VECTOR_DB_CLIENT.search returns one batch per query vector
+        self._multi_vector_search = True
+        self._worker: Optional[_BackgroundWorker] = None
+        self._worker_lock = threading.Lock()
+        self._state_stores: dict[str, _StateStore] = {}
+        self._state_stores_lock = threading.Lock()
+        self._embedding_cache: Optional[_EmbeddingCache] = None
+        self._embedding_cache_lock = threading.Lock()
+        self.prefilter_stats = {"passed": 0, "skipped": 0}
+        self._extra_patterns: tuple[str, Optional[re.Pattern]] = ("", None)
+        self._related_cache = _TTLCache(
+            self.valves.related_memories_cache_size,
+            self.valves.related_memories_cache_ttl,
+        )
+        # sha256 of an injected memory context block -> rewritten block
+        self._memory_context_cache = _TTLCache(256, float("inf"))
+        # Set metrics.sink to receive every observation as (name, value, labels)
+        self.metrics = _Metrics(log=self.log)
+        # (api_url, model) -> whether the endpoint accepts structured outputs
+        self._structured_output_support = _TTLCache(
+            256, self.valves.structured_output_recheck_interval
+        )
+        self._metrics_exported_at = 0.0
+        self._metrics_export_lock = threading.Lock()
+
+    def get_background_worker(self) -> _BackgroundWorker:
+        """Get the background worker, replacing it (after draining) if its valves changed."""
+        config = (
+            self.valves.background_workers,
+            self.valves.background_queue_size,
+            self.valves.background_queue_full_policy,
+            self.valves.background_enqueue_timeout,
+        )
+        with self._worker_lock:
+            old_worker = self._worker
+            if old_worker is not None and old_worker.config == config:
+                return old_worker
+
+            self._worker = _BackgroundWorker(*config, log=self.log)
+            atexit.register(self._worker.shutdown)
+            if old_worker is not None:
+                self.log("background worker valves changed, replacing worker")
+                atexit.unregister(old_worker.shutdown)
+                threading.Thread(target=old_worker.shutdown, daemon=True).start()
+            return self._worker
+
+    def export_metrics(self) -> str:
+        """
+        Render the pipeline metrics together with the background worker, cache and
+        pre-filter stats in the Prometheus text format.
+        """
+        families: list[tuple[str, str, str, MetricSeries]] = []
+        worker = self._worker
+        if worker is not None:
+            families.append(
+                (
+                    "background_jobs_total",
+                    "counter",
+                    "Background extraction jobs by outcome.",
+                    {(("outcome", k),): v for k, v in worker.stats.items()},
+                )
+            )
+            families.append(
+                (
+                    "background_backlog",
+                    "gauge",
+                    "Extraction jobs waiting in the background queue.",
+                    {(): worker.backlog},
+                )
+            )
+        families.append(
+            (
+                "prefilter_turns_total",
+                "counter",
+                "Turns scored by the pre-filter by result.",
+                {(("result", k),): v for k, v in self.prefilter_stats.items()},
+            )
+        )
 
-    def extract_memory_context(self, content: str) -> Optional[tuple[str, list[dict]]]:
+        caches = {"related_memories": self._related_cache.stats}
+        if self._embedding_cache is not None:
+            caches["embeddings"] = self._embedding_cache.stats
+        requests: MetricSeries = {}
+        entries: MetricSeries = {}
+        for cache_name, stats in caches.items():
+            for result in ("hits", "spill_hits", "misses"):
+                if result in stats:
+                    requests[(("cache", cache_name), ("result", result))] = stats[result]
+            entries[(("cache", cache_name),)] = stats["size"]
+        families.append(
+            ("cache_requests_total", "counter", "Cache lookups by result.", requests)
+        )
+        families.append(
+            ("cache_entries", "gauge", "Entries held in memory per cache.", entries)
+        )
+        return self.metrics.render(families)
+
+    def maybe_export_metrics(self) -> None:
+        """Write the metrics file if it is enabled and the export interval has passed."""
+        path = self.valves.metrics_textfile_path
+        if not path:
+            return
+        with self._metrics_export_lock:
+            now = time.monotonic()
+            if now - self._metrics_exported_at < self.valves.metrics_export_interval:
+                return
+            self._metrics_exported_at = now
+            # Write to a temporary file first so scrapers never read a partial file
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(self.export_metrics())
+                os.replace(tmp_path, path)
+            except OSError as e:
+                self.log(f"failed to write metrics file {path}: {e}", level="warning")
+
+    def get_openai_client(self, api_url: str, api_key: str) -> AsyncOpenAI:
         """
-        Extract memory context from system message content.
+        Get a cached AsyncOpenAI client for (api_url, api_key).
 
-        Returns:
-            tuple of (full_match_string, parsed_memories_list) if found, None otherwise
+        All clients on the running event loop share one keep-alive HTTP connection pool,
+        so repeated extractions reuse TCP/TLS connections. The pool is rebuilt when the
+        connection limit valves change.
         """
-        # Open WebUI uses this standard format
-        pattern = r"<memory_user_context>\s*(\[[\s\S]*?\])\s*</memory_user_context>"
-        match = re.search(pattern, content)
+        loop = asyncio.get_running_loop()
+        limits = (
+            self.valves.max_connections,
+            self.valves.max_keepalive_connections,
+            self.valves.keepalive_expiry,
+        )
 
-        if not match:
-            self.log("no memory context found in system message", level="debug")
-            return None
+        with self._openai_pools_lock:
+            pool = self._openai_pools.get(loop)
+            if pool is None or pool["limits"] != limits:
+                if pool is not None:
+                    # Keep a reference so the close task isn't garbage collected
+                    task = loop.create_task(pool["http_client"].aclose())
+                    self._pool_close_tasks.add(task)
+                    task.add_done_callback(self._pool_close_tasks.discard)
+                    self.log("connection pool limits changed, rebuilding pool")
+                http_client = DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=limits[0],
+                        max_keepalive_connections=limits[1],
+                        keepalive_expiry=limits[2],
+                    )
+                )
+                pool = {
+                    "limits": limits,
+                    "http_client": http_client,
+                    "clients": OrderedDict(),
+                }
+                self._openai_pools[loop] = pool
+
+            clients = pool["clients"]
+            client = clients.get((api_url, api_key))
+            if client is None:
+                self.log(f"creating OpenAI client for {api_url}", level="debug")
+                client = AsyncOpenAI(
+                    api_key=api_key,
+                    base_url=api_url,
+                    http_client=pool["http_client"],
+                )
+                clients[(api_url, api_key)] = client
+                # Per-user API keys would grow this without bound. Evicted clients
+                # are not closed: the HTTP pool they use is shared.
+                while len(clients) > MAX_CACHED_OPENAI_CLIENTS:
+                    clients.popitem(last=False)
+            else:
+                clients.move_to_end((api_url, api_key))
 
-        try:
-            memories_json = match.group(1)
-            memories_list = json.loads(memories_json)
-            self.log(
-                f"extracted {len(memories_list)} memories from context", level="debug"
-            )
-            return (match.group(0), memories_list)
-        except json.JSONDecodeError as e:
-            self.log(
-                f"failed to parse memory context JSON: {e}. raw content: {match.group(1)[:200]}...",
-                level="error",
-            )
-            return None
+        return client
 
     def format_memory_context(self, memories: list[dict]) -> str:
         """
@@ -888,6 +2185,9 @@ class Filter:
         Returns:
             Formatted memory context string to inject into system prompt
         """
+        if self.valves.memory_context_format == "compact":
+            return self.format_compact_memory_context(memories)
+
         # Remove similarity_score from each memory
         memories = [
             {k: v for k, v in mem.items() if k != "similarity_score"}
@@ -895,9 +2195,122 @@ class Filter:
         ]
 
         # Format with custom XML tag
-        memories_json = json.dumps(memories, indent=2, ensure_ascii=False)
+        memories_json = json.dumps(memories, ensure_ascii=False, separators=(",", ":"))
         return f"<long_term_memory>\n{memories_json}\n</long_term_memory>"
 
+    def format_compact_memory_context(self, memories: list[dict]) -> str:
+        """
+        Dense memory context: memories ranked by similarity and recency, near-duplicates
+        dropped, one '- [date] content' line each, capped at the token budget.
+        """
+        now = time.time()
+        recency_weight = self.valves.memory_context_recency_weight
+
+        def _rank(mem: dict) -> float:
+            similarity = mem.get("similarity_score")
+            similarity = similarity if isinstance(similarity, (int, float)) else 0.0
+            timestamp = _memory_timestamp(mem.get("updated_at") or mem.get("created_at"))
+            # 1.0 for today, 0.5 after 30 days, decaying towards 0
+            age_days = max(0.0, now - timestamp) / 86400 if timestamp else None
+            recency = 1 / (1 + age_days / 30) if age_days is not None else 0.0
+            return (1 - recency_weight) * similarity + recency_weight * recency
+
+        ranked = sorted(
+            (mem for mem in memories if isinstance(mem, dict) and mem.get("content")),
+            key=_rank,
+            reverse=True,
+        )
+
+        threshold = self.valves.memory_context_dedupe_threshold
+        budget = self.valves.memory_context_token_budget
+        kept_words: list[frozenset[str]] = []
+        lines: list[str] = []
+        used_tokens = 0
+        for mem in ranked:
+            content = " ".join(str(mem["content"]).split())
+            words = frozenset(re.findall(r"\w+", content.lower()))
+            if any(
+                words == other
+                or (
+                    words
+                    and other
+                    and len(words & other) / len(words | other) >= threshold
+                )
+                for other in kept_words
+            ):
+                continue
+
+            timestamp = _memory_timestamp(mem.get("created_at"))
+            if timestamp:
+                date = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+                line = f"- [{date}] {content}"
+            else:
+                line = f"- {content}"
+            if budget:
+                tokens = estimate_tokens(line)
+                if used_tokens + tokens > budget:
+                    if lines:
+                        break
+                    # Keep at least the best memory, shortened to the budget
+                    line = truncate_to_tokens(line, budget)
+                    tokens = estimate_tokens(line)
+                used_tokens += tokens
+            kept_words.append(words)
+            lines.append(line)
+
+        self.log(
+            f"compact memory context: kept {len(lines)}/{len(memories)} memories",
+            level="debug",
+        )
+        body = "\n".join(lines)
+        return f"<long_term_memory>\n{body}\n</long_term_memory>"
+
+    def rewrite_memory_context(self, content: str) -> tuple[str, int]:
+        """
+        Replace every memory context block in `content` with format_memory_context()
+        in a single pass, splicing at the match offsets. The same memories are injected
+        turn after turn, so rewritten blocks are cached by the hash of the original block.
+
+        Returns:
+            tuple of (rewritten content, number of blocks rewritten)
+        """
+        cache = self._memory_context_cache
+        rewritten = 0
+        # The compact format ranks by recency, so its output is only reused within a day
+        day = (
+            int(time.time() // 86400)
+            if self.valves.memory_context_format == "compact"
+            else None
+        )
+
+        def _rewrite_block(match: re.Match[str]) -> str:
+            nonlocal rewritten
+            block = match.group(0)
+            key = (
+                hashlib.sha256(block.encode()).digest(),
+                self.valves.memory_context_format,
+                self.valves.memory_context_token_budget,
+                self.valves.memory_context_recency_weight,
+                self.valves.memory_context_dedupe_threshold,
+                day,
+            )
+            new_context = cache.get(key)
+            if new_context is None:
+                try:
+                    memories_list = json.loads(match.group(1))
+                except json.JSONDecodeError as e:
+                    self.log(
+                        f"failed to parse memory context JSON: {e}. raw content: {match.group(1)[:200]}...",
+                        level="error",
+                    )
+                    return block
+                new_context = self.format_memory_context(memories_list)
+                cache.set(key, new_context)
+            rewritten += 1
+            return new_context
+
+        return MEMORY_CONTEXT_PATTERN.sub(_rewrite_block, content), rewritten
+
     def process_memory_context_in_messages(self, messages: list[dict]) -> list[dict]:
         """
         Process messages to intercept and optionally override memory context.
@@ -916,26 +2329,18 @@ class Filter:
                 continue
 
             content = message.get("content", "")
-            if not content:
+            if not content or not isinstance(content, str):
                 continue
 
-            # Try to extract existing memory context
-            extraction_result = self.extract_memory_context(content)
-
-            if extraction_result:
+            new_content, rewritten = self.rewrite_memory_context(content)
+            if rewritten:
                 found_any_memory_context = True
-                full_match, memories_list = extraction_result
-
-                # Override: format the memories using custom method
-                new_context = self.format_memory_context(memories_list)
-
-                # Replace in content
-                messages[i]["content"] = content.replace(full_match, new_context)
+                messages[i]["content"] = new_content
 
                 # Log successful override
                 self.log(
-                    f"overrode memory context in system message {i}: {len(memories_list)} memories processed, "
-                    f"similarity scores removed, XML tag changed to <long_term_memory>",
+                    f"overrode {rewritten} memory context block(s) in system message {i}: "
+                    f"similarity scores removed, XML tag changed to <long_term_memory>. cache stats={self._memory_context_cache.stats}",
                     level="info",
                 )
             else:
@@ -952,6 +2357,7 @@ class Filter:
 
     def get_restricted_user_valve(
         self,
+        ctx: MemoryRunContext,
         user_valve_value: Optional[ValveType],
         admin_fallback: ValveType,
         authorization_check: Optional[bool] = None,
@@ -961,6 +2367,7 @@ class Filter:
         Get user valve value with security checks.
 
         Args:
+            ctx: The invocation context of the user whose valve is checked
             user_valve_value: The user's valve value to check
             admin_fallback: Admin's fallback value
             authorization_check: The valve value to check for authorization (e.g., user's API key)
@@ -985,7 +2392,7 @@ class Filter:
             return user_valve_value if user_valve_value is not None else admin_fallback
 
         # Allow admins to override without providing their own API key
-        if hasattr(self, "current_user") and self.current_user.get("role") == "admin":
+        if ctx.current_user.get("role") == "admin":
             if user_valve_value is not None:
                 self.log(
                     f"'{valve_name or 'unknown'}' override allowed for admin user",
@@ -1008,6 +2415,123 @@ class Filter:
             )
         return admin_fallback
 
+    def get_state_store(self, namespace: str) -> _StateStore:
+        """Get the state store for a namespace, reopening it if `state_db_path` changed."""
+        with self._state_stores_lock:
+            store = self._state_stores.get(namespace)
+            if store is None or store.path != self.valves.state_db_path:
+                store = _StateStore(namespace, path=self.valves.state_db_path)
+                self._state_stores[namespace] = store
+            return store
+
+    @staticmethod
+    def _last_user_message_index(messages: list[dict[str, Any]]) -> int:
+        for idx in range(len(messages) - 1, -1, -1):
+            if messages[idx].get("role") == "user":
+                return idx
+        return -1
+
+    def get_processed_count(
+        self, messages: list[dict[str, Any]], ctx: MemoryRunContext
+    ) -> int:
+        """
+        Number of leading messages already analyzed for this chat. The watermark is
+        the count and content hash of the messages up to the last processed user
+        message, so regenerations and same-content edits are recognized, while any
+        edit of earlier messages invalidates it.
+        """
+        watermark = self.get_state_store("watermarks").get(
+            f"{ctx.user.id}:{ctx.chat_id}"
+        )
+        if not watermark:
+            return 0
+        count = watermark.get("count", 0)
+        if count > len(messages) or messages_digest(messages[:count]) != watermark.get(
+            "digest"
+        ):
+            self.log("chat history changed since last extraction", level="debug")
+            return 0
+        return count
+
+    def set_processed_count(
+        self, processed: list[dict[str, Any]], ctx: MemoryRunContext
+    ) -> None:
+        self.get_state_store("watermarks").set(
+            f"{ctx.user.id}:{ctx.chat_id}",
+            {"count": len(processed), "digest": messages_digest(processed)},
+        )
+
+    def classify_turn(
+        self, user_message: str, assistant_message: str
+    ) -> Optional[float]:
+        """
+        Optional local classifier for the pre-filter.
+        Override this method to plug in a small local model.
+
+        Returns:
+            Probability (0 to 1) that the turn contains memorable information, or None
+            to use the built-in heuristics
+        """
+        return None
+
+    def score_memorability(self, messages: list[dict[str, Any]]) -> float:
+        """
+        Cheap local score (0 to 1) of how likely the latest user turn contains durable
+        personal facts. Explicit memory requests always score 1, trivial turns 0. Other
+        turns score 1 unless `prefilter_mode` is 'heuristic'.
+        """
+        last_user_idx = self._last_user_message_index(messages)
+        if last_user_idx < 0:
+            return 0.0
+        user_message = message_text(messages[last_user_idx]).strip()
+        assistant_message = (
+            message_text(messages[last_user_idx + 1])
+            if last_user_idx + 1 < len(messages)
+            else ""
+        )
+
+        patterns_source = self.valves.prefilter_extra_patterns
+        if self._extra_patterns[0] != patterns_source:
+            lines = [line.strip() for line in patterns_source.splitlines() if line.strip()]
+            try:
+                compiled = (
+                    re.compile("|".join(f"(?:{line})" for line in lines), re.IGNORECASE)
+                    if lines
+                    else None
+                )
+            except re.error as e:
+                self.log(f"invalid prefilter_extra_patterns: {e}", level="error")
+                compiled = None
+            self._extra_patterns = (patterns_source, compiled)
+        extra_pattern = self._extra_patterns[1]
+
+        if MEMORY_REQUEST_PATTERN.search(user_message) or MEMORY_REQUEST_PATTERN.search(
+            assistant_message
+        ):
+            return 1.0
+        if extra_pattern is not None and extra_pattern.search(user_message):
+            return 1.0
+
+        classified = self.classify_turn(user_message, assistant_message)
+        if classified is not None:
+            return classified
+
+        if not user_message or TRIVIAL_TURN_PATTERN.match(user_message):
+            return 0.0
+        if self.valves.prefilter_mode == "trivial":
+            return 1.0
+
+        score = 0.0
+        if FIRST_PERSON_PATTERN.search(user_message):
+            score += 0.5
+        if PERSONAL_FACT_PATTERN.search(user_message):
+            score += 0.3
+        # Count CJK characters as words, since CJK text has no spaces
+        words = len(user_message.split()) + len(re.findall(r"[\u4e00-\u9fff]", user_message)) // 2
+        if words >= 8:
+            score += 0.3
+        return min(score, 1.0)
+
     def build_memory_query(self, messages: list[dict[str, Any]]) -> str:
         """
         Build a query string for memory retrieval from recent messages.
@@ -1026,7 +2550,7 @@ class Filter:
         for idx in range(len(messages) - 1, -1, -1):
             if messages[idx].get("role") == "user":
                 last_user_idx = idx
-                last_user_msg = messages[idx].get("content", "")
+                last_user_msg = message_text(messages[idx])
                 break
 
         if last_user_msg is None or last_user_idx is None:
@@ -1041,7 +2565,7 @@ class Filter:
         # Build query from most recent to older messages
         # Add last assistant response (if exists)
         if last_user_idx + 1 < len(messages):
-            last_assistant_msg = messages[last_user_idx + 1].get("content", "")
+            last_assistant_msg = message_text(messages[last_user_idx + 1])
             if last_assistant_msg:
                 query_parts.append(f"Assistant: {last_assistant_msg}")
 
@@ -1050,7 +2574,7 @@ class Filter:
 
         # If short message, add previous assistant context
         if include_extra_context and last_user_idx > 0:
-            prev_assistant_msg = messages[last_user_idx - 1].get("content", "")
+            prev_assistant_msg = message_text(messages[last_user_idx - 1])
             if (
                 prev_assistant_msg
                 and messages[last_user_idx - 1].get("role") == "assistant"
@@ -1069,22 +2593,131 @@ class Filter:
 
         return query
 
+    def build_memory_subqueries(self, messages: list[dict[str, Any]]) -> list[str]:
+        """
+        Focused queries for multi-query retrieval: the last user message alone, then
+        the sentences of the last user message and assistant reply that look most
+        personal (pre-filter patterns), at most `memory_subqueries_n`.
+        """
+        last_user_idx = self._last_user_message_index(messages)
+        if last_user_idx < 0:
+            return []
+        user_message = message_text(messages[last_user_idx]).strip()
+        assistant_message = ""
+        if last_user_idx + 1 < len(messages):
+            assistant_message = message_text(messages[last_user_idx + 1])
+
+        candidates: list[tuple[float, str]] = []
+        for text, from_user in ((user_message, True), (assistant_message, False)):
+            for sentence in re.split(r"(?<=[.!?。！？])\s+|\n+", text):
+                sentence = sentence.strip()
+                if len(sentence) < 12 or sentence == user_message:
+                    continue
+                score = 1.0 if PERSONAL_FACT_PATTERN.search(sentence) else 0.0
+                if from_user:
+                    score += 1.0 if FIRST_PERSON_PATTERN.search(sentence) else 0.0
+                    score += 1.0 if MEMORY_REQUEST_PATTERN.search(sentence) else 0.0
+                if score > 0:
+                    candidates.append((score, sentence))
+        # Stable sort keeps user sentences first among equal scores
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+        subqueries: list[str] = [user_message] if user_message else []
+        for _, sentence in candidates:
+            if sentence not in subqueries:
+                subqueries.append(sentence)
+        return subqueries[: self.valves.memory_subqueries_n]
+
+    def invalidate_related_memories(self, user_id: str) -> None:
+        """Drop cached related-memory results of a user after their memories changed."""
+        dropped = self._related_cache.invalidate(lambda key: key[0] == user_id)
+        if dropped:
+            self.log(
+                f"invalidated {dropped} cached related-memory results for user {user_id}",
+                level="debug",
+            )
+
     async def get_related_memories(
         self,
         messages: list[dict[str, Any]],
         user: UserModel,
-    ) -> list[Memory]:
-        memory_query = self.build_memory_query(messages)
+    ) -> list[MemoryRecord]:
+        with self.metrics.span("build_memory_query"):
+            memory_query = self.build_memory_query(messages)
+            subqueries: list[str] = []
+            if self.valves.multi_query_retrieval:
+                subqueries = [
+                    q for q in self.build_memory_subqueries(messages) if q != memory_query
+                ]
+        k = self.valves.related_memories_n
+        min_similarity = self.valves.minimum_memory_similarity
+
+        cache = self._related_cache
+        cache.max_entries = self.valves.related_memories_cache_size
+        cache.ttl = self.valves.related_memories_cache_ttl
+        normalized_query = "\n".join(
+            " ".join(query.split()) for query in [memory_query, *subqueries]
+        )
+        cache_key = (
+            user.id,
+            hashlib.sha256(normalized_query.encode()).hexdigest(),
+            k,
+            min_similarity,
+        )
 
-        # Query related memories
-        try:
-            results = await query_memory(
-                request=Request(scope={"type": "http", "app": webui_app}),
-                form_data=QueryMemoryForm(
-                    content=memory_query, k=self.valves.related_memories_n
-                ),
-                user=user,
+        related_memories = cache.get(cache_key) if cache.max_entries > 0 else None
+        if related_memories is not None:
+            self.log(
+                f"related memories cache hit. stats={cache.stats}", level="debug"
             )
+        else:
+            with self.metrics.span("query_memory"):
+                related_memories = await self.query_related_memories(
+                    memory_query,
+                    user=user,
+                    k=k,
+                    subqueries=subqueries,
+                    min_similarity=min_similarity,
+                )
+            cache.set(cache_key, related_memories)
+            self.log(
+                f"related memories cache miss. stats={cache.stats}", level="debug"
+            )
+
+        self.log(f"using {len(related_memories)} related memories", level="info")
+        self.log(f"related memories: {related_memories}", level="debug")
+
+        return related_memories
+
+    async def query_related_memories(
+        self,
+        memory_query: str,
+        user: UserModel,
+        k: int,
+        subqueries: Optional[list[str]] = None,
+        min_similarity: Optional[float] = None,
+    ) -> list[MemoryRecord]:
+        """
+        Search the user's memory collection for `memory_query`. The query is embedded
+        through embed_texts (so the embedding cache applies); the memory query router is
+        used if the embedding function is not available.
+
+        `subqueries` are embedded in the same batch and searched in the same call; the
+        result lists are merged with reciprocal rank fusion. Hits below
+        `min_similarity` are dropped before they are converted.
+        """
+        queries = [memory_query, *(subqueries or [])]
+        try:
+            try:
+                vectors = await self.embed_texts(queries, user=user)
+            except EmbeddingUnavailableError:
+                results = await query_memory(
+                    request=Request(scope={"type": "http", "app": webui_app}),
+                    form_data=QueryMemoryForm(content=memory_query, k=k),
+                    user=user,
+                )
+            else:
+                results = await self.search_memory_vectors(vectors, user=user, k=k)
         except HTTPException as e:
             if e.status_code == 404:
                 self.log("no related memories found", level="info")
@@ -1099,88 +2732,189 @@ class Filter:
             self.log(f"failed to query memories: {e}", level="error")
             raise RuntimeError("failed to query memories") from e
 
-        related_memories = searchresults_to_memories(results) if results else []
-        self.log(
-            f"found {len(related_memories)} related memories before filtering",
-            level="info",
+        if not isinstance(results, list):
+            results = [results]
+        results = [result for result in results if result]
+        if not results:
+            return []
+        rankings = [
+            ranking
+            for result in results
+            for ranking in searchresults_to_memory_batches(result, min_similarity)
+        ]
+        total = sum(
+            len(ids_batch) for result in results for ids_batch in result.ids or []
         )
+        kept = sum(len(ranking) for ranking in rankings)
+        if kept < total:
+            self.log(
+                f"filtered out {total - kept} memories below similarity threshold {min_similarity}",
+                level="info",
+            )
+        if len(rankings) == 1:
+            return rankings[0]
 
-        # Filter by minimum similarity if configured
-        if self.valves.minimum_memory_similarity is not None:
-            filtered_memories = [
-                mem
-                for mem in related_memories
-                if mem.similarity_score is not None
-                and mem.similarity_score >= self.valves.minimum_memory_similarity
-            ]
-            filtered_count = len(related_memories) - len(filtered_memories)
-            if filtered_count > 0:
-                self.log(
-                    f"filtered out {filtered_count} memories below similarity threshold {self.valves.minimum_memory_similarity}",
-                    level="info",
-                )
-            related_memories = filtered_memories
+        fused = fuse_memory_rankings(rankings, k)
+        self.log(
+            f"fused {kept} results of {len(rankings)} queries into {len(fused)} memories",
+            level="debug",
+        )
+        return fused
 
-        self.log(f"using {len(related_memories)} related memories", level="info")
-        self.log(f"related memories: {related_memories}", level="debug")
+    async def search_memory_vectors(
+        self, vectors: list[list[float]], user: UserModel, k: int
+    ) -> list[Optional[SearchResult]]:
+        """
+        Search the user's memory collection with several vectors in one call. Some
+        vector DB backends only search the first vector; if the result doesn't have one
+        batch per vector, the backend is remembered and each vector is searched
+        separately (concurrently) from then on.
+        """
+        collection_name = f"user-memory-{user.id}"
+        if len(vectors) == 1 or self._multi_vector_search:
+            result = await asyncio.to_thread(
+                VECTOR_DB_CLIENT.search,
+                collection_name=collection_name,
+                vectors=vectors,
+                limit=k,
+            )
+            if len(vectors) == 1 or not result or len(result.ids or []) == len(vectors):
+                return [result]
+            self._multi_vector_search = False
+            self.log(
+                f"vector DB returned {len(result.ids or [])} result batches for {len(vectors)} query vectors; searching each vector separately from now on",
+                level="warning",
+            )
 
-        return related_memories
+        return list(
+            await asyncio.gather(
+                *(
+                    asyncio.to_thread(
+                        VECTOR_DB_CLIENT.search,
+                        collection_name=collection_name,
+                        vectors=[vector],
+                        limit=k,
+                    )
+                    for vector in vectors
+                )
+            )
+        )
 
     async def auto_memory(
         self,
         messages: list[dict[str, Any]],
-        user: UserModel,
+        ctx: MemoryRunContext,
         emitter: Callable[[Any], Awaitable[None]],
     ) -> None:
         """Execute the auto-memory extraction and update flow."""
+        outcome = "failed"
+        try:
+            with self.metrics.span("auto_memory"):
+                outcome = await self._auto_memory(messages, ctx=ctx, emitter=emitter)
+        finally:
+            self.metrics.inc("runs_total", outcome=outcome)
+            self.maybe_export_metrics()
+
+    async def _auto_memory(
+        self,
+        messages: list[dict[str, Any]],
+        ctx: MemoryRunContext,
+        emitter: Callable[[Any], Awaitable[None]],
+    ) -> str:
+        """Run the extraction flow and return its outcome for the metrics."""
 
         if len(messages) < 2:
             self.log("need at least 2 messages for context", level="debug")
-            return
-        self.log(f"flow started. user ID: {user.id}", level="debug")
+            return "too_short"
+        self.log(f"flow started. user ID: {ctx.user.id}", level="debug")
+
+        processed_count = 0
+        watermark_count = self._last_user_message_index(messages) + 1
+        if self.valves.incremental_extraction and ctx.chat_id:
+            processed_count = self.get_processed_count(messages, ctx)
+            if processed_count >= watermark_count:
+                self.log(
+                    "no new user message since last extraction, skipping", level="info"
+                )
+                return "no_new_message"
+            if processed_count:
+                self.log(
+                    f"{processed_count} messages already processed, sending them as shortened context",
+                    level="debug",
+                )
 
-        related_memories = await self.get_related_memories(messages=messages, user=user)
+        if self.valves.prefilter_enabled:
+            score = self.score_memorability(messages)
+            if score < self.valves.prefilter_threshold:
+                self.prefilter_stats["skipped"] += 1
+                self.log(
+                    f"pre-filter skipped turn (score={score:.2f} < {self.valves.prefilter_threshold}). stats={self.prefilter_stats}",
+                    level="info",
+                )
+                if self.valves.incremental_extraction and ctx.chat_id:
+                    self.set_processed_count(messages[:watermark_count], ctx)
+                return "prefiltered"
+            self.prefilter_stats["passed"] += 1
+            self.log(f"pre-filter passed turn (score={score:.2f})", level="debug")
+
+        related_memories = await self.get_related_memories(
+            messages=messages, user=ctx.user
+        )
 
         stringified_memories = json.dumps(
-            [memory.model_dump(mode="json") for memory in related_memories]
+            [memory.to_memory().model_dump(mode="json") for memory in related_memories]
+        )
+        conversation_str = self.messages_to_string(
+            messages, ctx=ctx, processed_count=processed_count
         )
-        conversation_str = self.messages_to_string(messages)
 
         try:
-            action_plan = await self.query_openai_sdk(
-                system_prompt=UNIFIED_SYSTEM_PROMPT,
-                user_message=f"Conversation snippet:\n{conversation_str}\n\nRelated Memories:\n{stringified_memories}",
-                response_model=build_actions_request_model(
+            with self.metrics.span("build_actions_request_model"):
+                response_model = build_actions_request_model(
                     [m.mem_id for m in related_memories]
-                ),
-            )
+                )
+            with self.metrics.span("llm"):
+                action_plan = await self.query_openai_sdk(
+                    ctx=ctx,
+                    system_prompt=UNIFIED_SYSTEM_PROMPT,
+                    user_message=f"Conversation snippet:\n{conversation_str}\n\nRelated Memories:\n{stringified_memories}",
+                    response_model=response_model,
+                )
             self.log(f"action plan: {action_plan}", level="debug")
 
-            await self.apply_memory_actions(
-                action_plan=action_plan,  # pyright: ignore[reportArgumentType]
-                user=user,
-                emitter=emitter,
-            )
+            with self.metrics.span("apply_memory_actions"):
+                await self.apply_memory_actions(
+                    action_plan=action_plan,  # pyright: ignore[reportArgumentType]
+                    ctx=ctx,
+                    emitter=emitter,
+                )
+
+            if self.valves.incremental_extraction and ctx.chat_id:
+                self.set_processed_count(messages[:watermark_count], ctx)
 
         except Exception as e:
             self.log(f"LLM query failed: {e}", level="error")
-            if self.user_valves.show_status:
+            if ctx.user_valves.show_status:
                 await emit_status(
                     "memory processing failed", emitter=emitter, status="error"
                 )
-            return None
+            return "failed"
+
+        return "completed"
 
     async def apply_memory_actions(
         self,
         action_plan: MemoryActionRequestStub,
-        user: UserModel,
+        ctx: MemoryRunContext,
         emitter: Callable[[Any], Awaitable[None]],
     ) -> None:
         """
         Execute memory actions from the plan.
-        Order: delete -> update -> add (prevents conflicts)
+        Order: delete -> update -> add (prevents conflicts). Actions of the same type
+        run concurrently, bounded by the `action_concurrency` valve.
         """
         self.log("started apply_memory_actions", level="debug")
+        user = ctx.user
         actions = action_plan.actions
 
         # Show processing status
@@ -1230,33 +2964,88 @@ class Filter:
             },
         }
 
-        # Process all operations in order
+        semaphore = asyncio.Semaphore(self.valves.action_concurrency)
+
+        # Embed the contents of all update and add actions in one call up front; the
+        # vectors don't depend on the delete -> update -> add order
+        embedded: dict[int, list[float]] = {}
+        to_embed = [
+            a
+            for op_name in ("update", "add")
+            for a in operations[op_name]["actions"]
+            if not operations[op_name]["skip_empty"](a)
+        ]
+        if self.valves.batch_embeddings and to_embed:
+            try:
+                vectors = await self.embed_texts(
+                    [self._action_content(a) for a in to_embed], user=user
+                )
+                embedded = {id(a): v for a, v in zip(to_embed, vectors)}
+                self.log(
+                    f"embedded {len(to_embed)} update/add contents in one batch",
+                    level="debug",
+                )
+            except Exception as e:
+                self.log(
+                    f"batched embedding failed, falling back to per-action requests: {e}",
+                    level="warning",
+                )
+
+        # Process all operations in order; actions within one operation run concurrently
         for op_name, op_config in operations.items():
             total = len(op_config["actions"])
-            index = 0
-            for action in op_config["actions"]:
-                if op_config["skip_empty"](action):
-                    continue
-                try:
-                    await op_config["handler"](action)
-                    self.log(op_config["log_msg"](action))
-                    index += 1
-                    if self.user_valves.show_status:
-                        if action.action == "add":
-                            detail = action.content
-                        elif action.action == "update":
-                            detail = action.new_content
+            pending = [a for a in op_config["actions"] if not op_config["skip_empty"](a)]
+            if total > len(pending):
+                self.metrics.inc(
+                    "actions_total", total - len(pending), action=op_name, outcome="skipped"
+                )
+            if not pending:
+                continue
+
+            vectors = [embedded.get(id(a)) for a in pending]
+
+            progress = {"index": 0}
+
+            async def _run(action, vector: Optional[list[float]]):
+                async with semaphore:
+                    with self.metrics.span(f"{op_name}_memory"):
+                        if vector is None:
+                            await op_config["handler"](action)
                         else:
-                            detail = action.id
-                        await emit_status(
-                            f"{op_config['status_verb']} {index}/{total}: {detail}",
-                            emitter=emitter,
-                            status="complete",
-                        )
-                except Exception as e:
-                    raise RuntimeError(op_config["error_msg"](action, e))
+                            await asyncio.to_thread(
+                                self._write_memory_with_vector, action, vector, user
+                            )
+                self.log(op_config["log_msg"](action))
+                progress["index"] += 1
+                if ctx.user_valves.show_status:
+                    await emit_status(
+                        f"{op_config['status_verb']} {progress['index']}/{total}: {self._action_content(action)}",
+                        emitter=emitter,
+                        status="complete",
+                    )
 
-        if self.user_valves.show_status and len(actions) > 0:
+            results = await asyncio.gather(
+                *(_run(a, v) for a, v in zip(pending, vectors)),
+                return_exceptions=True,
+            )
+            self.invalidate_related_memories(user.id)
+            failures = [
+                (action, result)
+                for action, result in zip(pending, results)
+                if isinstance(result, BaseException)
+            ]
+            for outcome, count in (
+                ("applied", len(pending) - len(failures)),
+                ("failed", len(failures)),
+            ):
+                if count:
+                    self.metrics.inc(
+                        "actions_total", count, action=op_name, outcome=outcome
+                    )
+            if failures:
+                raise RuntimeError(op_config["error_msg"](*failures[0]))
+
+        if ctx.user_valves.show_status and len(actions) > 0:
             await emit_status(
                 "🧠 本次对话的新信息我已经记在脑子里了",
                 emitter=emitter,
@@ -1264,6 +3053,270 @@ class Filter:
             )
         self.log("memory actions completed", level="info")
 
+    async def maybe_schedule_compaction(
+        self, ctx: MemoryRunContext, worker: _BackgroundWorker
+    ) -> None:
+        """Submit a compaction job for the user if their last run is old enough."""
+        store = self.get_state_store("compaction")
+        last_run = store.get(f"{ctx.user.id}:last_run") or 0.0
+        if time.time() - last_run < self.valves.compaction_interval_hours * 3600:
+            return
+        store.set(f"{ctx.user.id}:last_run", time.time())
+        await worker.submit(
+            lambda: self.compact_memories(ctx), key=("compaction", ctx.user.id)
+        )
+
+    async def compact_memories(
+        self, ctx: MemoryRunContext, dry_run: Optional[bool] = None
+    ) -> dict[str, Any]:
+        """
+        Find clusters of near-duplicate memories of a user (SimHash over the memory
+        text) and merge each into one memory, through the same routers as
+        apply_memory_actions. Returns a report of the clusters and the planned
+        actions; with `dry_run` (default: the `compaction_dry_run` valve) nothing is
+        changed.
+        """
+        dry_run = self.valves.compaction_dry_run if dry_run is None else dry_run
+        user = ctx.user
+        with self.metrics.span("compaction"):
+            memories = (
+                await asyncio.to_thread(Memories.get_memories_by_user_id, user.id) or []
+            )
+            fingerprints = [memory_simhash(m.content) for m in memories]
+            clusters = [
+                [memories[i] for i in members]
+                for members in cluster_near_duplicates(
+                    fingerprints, self.valves.compaction_max_distance
+                )
+            ]
+            clusters.sort(key=len, reverse=True)
+            clusters = clusters[: self.valves.compaction_max_clusters]
+
+            actions: list[Any] = []
+            if clusters and self.valves.compaction_merge == "llm":
+                try:
+                    actions = await self.plan_compaction_with_llm(clusters, ctx)
+                except Exception as e:
+                    self.log(
+                        f"LLM compaction failed, falling back to rules: {e}",
+                        level="warning",
+                    )
+                    actions = self.plan_compaction_with_rules(clusters)
+            elif clusters:
+                actions = self.plan_compaction_with_rules(clusters)
+
+            report = {
+                "user_id": user.id,
+                "dry_run": dry_run,
+                "memories": len(memories),
+                "clusters": [
+                    [{"id": m.id, "content": m.content} for m in cluster]
+                    for cluster in clusters
+                ],
+                "actions": [action.model_dump() for action in actions],
+            }
+            self.log(
+                f"memory compaction report: {json.dumps(report, ensure_ascii=False)}",
+                level="info",
+            )
+            self.get_state_store("compaction").set(f"{user.id}:report", report)
+
+            if actions and not dry_run:
+                # Compaction runs outside of any chat, so no status is emitted
+                quiet_ctx = MemoryRunContext(
+                    user=user,
+                    current_user=ctx.current_user,
+                    user_valves=ctx.user_valves.model_copy(update={"show_status": False}),
+                )
+                await self.apply_memory_actions(
+                    action_plan=MemoryActionRequestStub.model_construct(actions=actions),
+                    ctx=quiet_ctx,
+                    emitter=None,  # pyright: ignore[reportArgumentType]
+                )
+        self.metrics.inc(
+            "compaction_runs_total", outcome="dry_run" if dry_run else "applied"
+        )
+        return report
+
+    @staticmethod
+    def plan_compaction_with_rules(clusters: list[list[Any]]) -> list[Any]:
+        """Keep the most recently updated memory of each cluster, delete the others."""
+        actions: list[Any] = []
+        for cluster in clusters:
+            keep = max(cluster, key=lambda m: (m.updated_at or 0, m.created_at or 0))
+            actions += [
+                MemoryDeleteAction(action="delete", id=m.id)
+                for m in cluster
+                if m.id != keep.id
+            ]
+        return actions
+
+    async def plan_compaction_with_llm(
+        self, clusters: list[list[Any]], ctx: MemoryRunContext
+    ) -> list[Any]:
+        """
+        Merge clusters with one LLM call. Only update/delete actions on members are
+        kept. Clusters that don't fit in the call, or whose plan doesn't leave exactly
+        one consistent survivor, are planned with the rules.
+        """
+        # A plan holds at most 20 actions, and a cluster needs up to one per member
+        batch: list[list[Any]] = []
+        leftover: list[list[Any]] = []
+        batch_size = 0
+        for cluster in clusters:
+            if batch_size + len(cluster) > 20:
+                leftover.append(cluster)
+                continue
+            batch.append(cluster)
+            batch_size += len(cluster)
+        leftover_actions = self.plan_compaction_with_rules(leftover)
+        if not batch:
+            return leftover_actions
+
+        member_ids = [m.id for cluster in batch for m in cluster]
+        payload = [
+            [
+                {
+                    "id": m.id,
+                    "content": m.content,
+                    "updated_at": datetime.fromtimestamp(
+                        m.updated_at or m.created_at or 0
+                    ).isoformat(),
+                }
+                for m in cluster
+            ]
+            for cluster in batch
+        ]
+        plan = await self.query_openai_sdk(
+            ctx=ctx,
+            system_prompt=COMPACTION_SYSTEM_PROMPT,
+            user_message=f"Clusters:\n{json.dumps(payload, ensure_ascii=False)}",
+            response_model=build_actions_request_model(member_ids),
+        )
+        actions = [
+            action
+            for action in plan.actions  # pyright: ignore[reportAttributeAccessIssue]
+            if action.action in ("update", "delete") and action.id in member_ids
+        ]
+
+        planned: list[Any] = []
+        invalid: list[list[Any]] = []
+        for cluster in batch:
+            ids = {m.id for m in cluster}
+            cluster_actions = [a for a in actions if a.id in ids]
+            if not cluster_actions:
+                continue  # not actually duplicates
+            updated = [a.id for a in cluster_actions if a.action == "update"]
+            deleted = {a.id for a in cluster_actions if a.action == "delete"}
+            if (
+                len(ids - deleted) != 1
+                or len(updated) > 1
+                or deleted.intersection(updated)
+            ):
+                invalid.append(cluster)
+            else:
+                planned.extend(cluster_actions)
+        if invalid:
+            self.log(
+                f"compaction plan invalid for {len(invalid)} cluster(s), using rules instead",
+                level="warning",
+            )
+        return planned + self.plan_compaction_with_rules(invalid) + leftover_actions
+
+    @staticmethod
+    def _action_content(action: Any) -> str:
+        if action.action == "add":
+            return action.content
+        if action.action == "update":
+            return action.new_content
+        return action.id
+
+    def get_embedding_cache(self) -> Optional[_EmbeddingCache]:
+        """Get the embedding cache, rebuilding it if its valves changed."""
+        max_bytes = int(self.valves.embedding_cache_max_mb * 1024 * 1024)
+        if max_bytes <= 0:
+            return None
+        with self._embedding_cache_lock:
+            cache = self._embedding_cache
+            if cache is None or cache.spill_path != self.valves.embedding_cache_spill_path:
+                cache = _EmbeddingCache(
+                    max_bytes, spill_path=self.valves.embedding_cache_spill_path
+                )
+                self._embedding_cache = cache
+            cache.max_bytes = max_bytes
+            return cache
+
+    async def embed_texts(self, texts: list[str], user: UserModel) -> list[list[float]]:
+        """
+        Embed several texts with a single call to Open WebUI's embedding function.
+        Texts found in the embedding cache are not sent to the embedding model.
+        """
+        embedding_function = getattr(webui_app.state, "EMBEDDING_FUNCTION", None)
+        if embedding_function is None:
+            raise EmbeddingUnavailableError("embedding function is not available")
+
+        cache = self.get_embedding_cache()
+        embedding_model = str(
+            getattr(getattr(webui_app.state, "config", None), "RAG_EMBEDDING_MODEL", "")
+        )
+        keys = [_EmbeddingCache.key_for(text, embedding_model) for text in texts]
+        results: list[Optional[list[float]]] = [
+            cache.get(key) if cache else None for key in keys
+        ]
+        missing = [i for i, vector in enumerate(results) if vector is None]
+
+        if missing:
+            with self.metrics.span("embed"):
+                vectors = embedding_function([texts[i] for i in missing], user=user)
+                if inspect.isawaitable(vectors):
+                    vectors = await vectors
+            if not isinstance(vectors, list) or len(vectors) != len(missing):
+                raise RuntimeError(
+                    f"embedding backend returned {len(vectors) if isinstance(vectors, list) else type(vectors)} vectors for {len(missing)} texts"
+                )
+            for i, vector in zip(missing, vectors):
+                results[i] = vector
+                if cache:
+                    cache.set(keys[i], vector)
+
+        if cache:
+            self.log(
+                f"embedded {len(missing)}/{len(texts)} texts. cache stats={cache.stats}",
+                level="debug",
+            )
+        return cast(list[list[float]], results)
+
+    def _write_memory_with_vector(
+        self, action: Any, vector: list[float], user: UserModel
+    ) -> None:
+        """
+        Same as the add/update memory routers, but with a precomputed embedding so the
+        router doesn't embed the content again.
+        """
+        if action.action == "add":
+            memory = Memories.insert_new_memory(user.id, action.content)
+        else:
+            memory = Memories.update_memory_by_id_and_user_id(
+                action.id, user.id, action.new_content
+            )
+        if memory is None:
+            raise ValueError(f"memory {getattr(action, 'id', '')} not found")
+
+        VECTOR_DB_CLIENT.upsert(
+            collection_name=f"user-memory-{user.id}",
+            items=[
+                {
+                    "id": memory.id,
+                    "text": memory.content,
+                    "vector": vector,
+                    "metadata": {
+                        "created_at": memory.created_at,
+                        "updated_at": memory.updated_at,
+                    },
+                }
+            ],
+        )
+
     def inlet(
         self,
         body: dict,
@@ -1306,7 +3359,6 @@ class Filter:
         user = Users.get_user_by_id(__user__["id"])
         if user is None:
             raise ValueError("user not found")
-        self.current_user = __user__
 
         self.log(f"input user type = {type(__user__)}", level="debug")
         self.log(
@@ -1321,20 +3373,32 @@ class Filter:
             )
             return body
 
-        self.user_valves = __user__.get("valves", self.UserValves())
-        if not isinstance(self.user_valves, self.UserValves):
+        user_valves = __user__.get("valves", self.UserValves())
+        if not isinstance(user_valves, self.UserValves):
             raise ValueError("invalid user valves")
-        self.user_valves = cast(Filter.UserValves, self.user_valves)
-        self.log(f"user valves = {self.user_valves}", level="debug")
+        user_valves = cast(Filter.UserValves, user_valves)
+        self.log(f"user valves = {user_valves}", level="debug")
 
-        if not self.user_valves.enabled:
+        if not user_valves.enabled:
             self.log("component was disabled by user, skipping", level="info")
             return body
 
-        _run_detached(
-            self.auto_memory(
-                body.get("messages", []), user=user, emitter=__event_emitter__
-            )
+        ctx = MemoryRunContext(
+            user=user, current_user=__user__, user_valves=user_valves, chat_id=chat_id
+        )
+        messages = body.get("messages", [])
+        worker = self.get_background_worker()
+        accepted = await worker.submit(
+            lambda: self.auto_memory(messages, ctx=ctx, emitter=__event_emitter__),
+            key=(user.id, chat_id),
+            delay=self.valves.debounce_seconds,
+        )
+        if not accepted:
+            self.log("memory extraction job was dropped", level="warning")
+        if self.valves.compaction_enabled:
+            await self.maybe_schedule_compaction(ctx, worker)
+        self.log(
+            f"background backlog={worker.backlog} stats={worker.stats}", level="debug"
         )
 
         return body
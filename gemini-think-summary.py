@@ -9,7 +9,7 @@ funding_url: https://github.com/GrayXu/OpenWebUI-Funcs
 import asyncio
 import contextvars
 import re
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pydantic import BaseModel, Field
 from typing import Optional, Callable, Awaitable
 
@@ -17,15 +17,32 @@ from typing import Optional, Callable, Awaitable
 class Filter:
     @dataclass
     class _StreamState:
-        reasoning_buffer: str = ""
-        scan_pos: int = 0
+        # Chunks of the trailing partial line of the reasoning stream; complete lines
+        # are dropped once scanned, so memory stays O(longest line).
+        pending_line: list[str] = field(default_factory=list)
         last_summary: str = ""
         event_emitter: Optional[Callable[[dict], Awaitable[None]]] = None
         finished_emitted: bool = False
         in_reasoning: bool = False
+        # Status emitter worker: single-slot "latest wins" mailbox plus a final slot
+        # that is always delivered last.
+        status_mailbox: Optional[dict] = None
+        status_final: Optional[dict] = None
+        status_wakeup: Optional[asyncio.Event] = None
+        status_task: Optional[asyncio.Task] = None
+        last_status_at: float = 0.0
+        stream_done: bool = False
 
     class Valves(BaseModel):
         priority: int = Field(default=100, description="priority")
+        status_min_interval: float = Field(
+            default=0.5,
+            ge=0.0,
+            description="minimum seconds between status updates; intermediate summaries are coalesced (latest wins)",
+        )
+
+    # Stop the status worker if a stream goes quiet without finishing
+    _STATUS_IDLE_TIMEOUT = 60.0
 
     def __init__(self):
         self.valves = self.Valves()
@@ -39,8 +56,7 @@ class Filter:
     ) -> dict:
         self._state_ctx.set(
             self._StreamState(
-                reasoning_buffer="",
-                scan_pos=0,
+                pending_line=[],
                 last_summary="",
                 event_emitter=__event_emitter__,
                 finished_emitted=False,
@@ -60,29 +76,24 @@ class Filter:
                 chunk += message["reasoning_content"]
         return chunk
 
-    def _extract_new_summary(self, state: _StreamState) -> Optional[str]:
-        if state.scan_pos >= len(state.reasoning_buffer):
-            return None
-
-        segment = state.reasoning_buffer[state.scan_pos :]
-        lines = segment.splitlines(keepends=True)
-        if not lines:
+    def _extract_new_summary(self, state: _StreamState, chunk: str) -> Optional[str]:
+        # Chunks without a line break are only buffered. Otherwise the pending partial
+        # line is joined with the chunk and everything up to the last line break is
+        # consumed.
+        cut = max(chunk.rfind("\n"), chunk.rfind("\r"))
+        if cut < 0:
+            state.pending_line.append(chunk)
             return None
 
-        consumed = 0
+        complete = "".join(state.pending_line) + chunk[: cut + 1]
+        state.pending_line = [chunk[cut + 1 :]] if cut + 1 < len(chunk) else []
         newest = None
 
-        for line in lines:
-            if not line.endswith(("\n", "\r")):
-                break
-            consumed += len(line)
-            stripped = line.strip()
-            match = self._bold_line_re.fullmatch(stripped)
+        for line in complete.splitlines():
+            match = self._bold_line_re.fullmatch(line.strip())
             if match:
                 newest = match.group(1).strip()
 
-        state.scan_pos += consumed
-
         if newest and newest != state.last_summary:
             state.last_summary = newest
             return newest
@@ -92,7 +103,13 @@ class Filter:
     async def outlet(
         self, body: dict, __event_emitter__, __user__: Optional[dict] = None
     ) -> dict:
-        # No-op in outlet; this filter only monitors streaming reasoning content.
+        # This filter only monitors streaming reasoning content; just make sure no
+        # status worker outlives the stream.
+        state = self._state_ctx.get()
+        if state is not None and state.status_task and not state.status_task.done():
+            state.stream_done = True
+            if state.status_wakeup:
+                state.status_wakeup.set()
         return body
 
     def _emit_status(
@@ -109,15 +126,67 @@ class Filter:
                 "hidden": False,
             },
         }
-        try:
-            asyncio.create_task(state.event_emitter(payload))
-        except RuntimeError:
-            return
+        if finished:
+            state.status_final = payload
+        else:
+            state.status_mailbox = payload
+        self._wake_status_worker(state)
+
+    def _wake_status_worker(self, state: _StreamState) -> None:
+        if state.status_task is None or state.status_task.done():
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            state.status_wakeup = asyncio.Event()
+            state.status_task = loop.create_task(self._status_worker(state))
+        if state.status_wakeup:
+            state.status_wakeup.set()
+
+    async def _status_worker(self, state: _StreamState) -> None:
+        """Deliver queued statuses in order, at most one per `status_min_interval`."""
+        loop = asyncio.get_running_loop()
+        wakeup = state.status_wakeup
+        assert wakeup is not None and state.event_emitter is not None
+        while True:
+            if state.status_mailbox is None and state.status_final is None:
+                if state.stream_done:
+                    return
+                try:
+                    await asyncio.wait_for(wakeup.wait(), self._STATUS_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    return
+            wakeup.clear()
+
+            delay = state.last_status_at + self.valves.status_min_interval - loop.time()
+            if delay > 0 and state.status_final is None:
+                await asyncio.sleep(delay)
+
+            if state.status_final is not None:
+                # Final status supersedes any pending summary and ends the worker
+                payload, state.status_final = state.status_final, None
+                state.status_mailbox = None
+                state.stream_done = True
+            else:
+                payload, state.status_mailbox = state.status_mailbox, None
+            if payload is None:
+                continue
+
+            try:
+                await state.event_emitter(payload)
+            except Exception:
+                pass
+            state.last_status_at = loop.time()
 
     def stream(self, event: dict) -> dict:
         state = self._state_ctx.get()
         if state is None:
             state = self._StreamState()
+        if any(choice.get("finish_reason") for choice in event.get("choices", [])):
+            # Let the status worker flush what is pending and exit
+            state.stream_done = True
+            if state.status_wakeup:
+                state.status_wakeup.set()
         reasoning_chunk = self._collect_reasoning_chunk(event)
         if not reasoning_chunk:
             if state.in_reasoning and not state.finished_emitted:
@@ -136,9 +205,8 @@ class Filter:
                     state.finished_emitted = True
             return event
 
-        state.reasoning_buffer += reasoning_chunk
         state.in_reasoning = True
-        summary = self._extract_new_summary(state)
+        summary = self._extract_new_summary(state, reasoning_chunk)
         if summary:
             self._emit_status(state, summary)
         return event
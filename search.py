@@ -6,98 +6,562 @@ author_url: https://github.com/GrayXu
 funding_url: https://github.com/GrayXu/OpenWebUI-Funcs
 """
 
+import functools
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+from collections import OrderedDict, deque
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import Literal, Optional, Callable, Deque, Dict, Any, Tuple
+
+
+# Model mapping based on README.md
+DEFAULT_MODEL_MAPPING: Dict[str, Dict[str, Any]] = {
+    "deepseek": {
+        "base": "",
+        "search": None,
+        "think": "-thinking",
+        "think_search": None,
+        "suffix": True,
+    },
+    "gemini-2.5-flash": {
+        "base": "gemini-2.5-flash",
+        "search": "gemini-2.5-flash-search",
+        "think": "gemini-2.5-flash-thinking",
+        "think_search": "gemini-2.5-flash-search",
+    },
+    "gemini-2.5-pro": {
+        "base": "gemini-2.5-pro",
+        "search": "gemini-2.5-pro-search-show",
+        "think": "gemini-2.5-pro-thinking",
+        "think_search": "gemini-2.5-pro-search-show-thinking",
+    },
+    "gemini": {
+        "base": "-preview",
+        "search": "-search-show",
+        "think": "-thinking",
+        "think_search": "-search-show-thinking",
+        "suffix": True,
+    },
+    "doubao-seed": {
+        "base": "",
+        "search": None,
+        "think": "-thinking",
+        "think_search": None,
+        "suffix": True,
+    },
+    "claude": {
+        "base": "",
+        "search": None,
+        "think": "-thinking",
+        "think_search": None,
+        "suffix": True,
+    },
+    "qwen": {
+        "base": "",
+        "search": None,
+        "think": "-thinking",
+        "think_search": None,
+        "suffix": True,
+    },
+    "gpt": {
+        "base": "gpt-5",
+        "search": None,
+        "think": "gpt-5-high",
+        "think_search": None,
+    },
+}
+
+class ModelRoute(BaseModel):
+    """Schema of one model mapping entry. Targets are full model names, or suffixes
+    appended to the current model when `suffix` is true. None keeps the model."""
+
+    model_config = {"extra": "forbid"}
+
+    base: Optional[str] = None
+    search: Optional[str] = None
+    think: Optional[str] = None
+    think_search: Optional[str] = None
+    suffix: bool = False
+
+
+def parse_model_mapping(text: str, path: str = "") -> Dict[str, Dict[str, Any]]:
+    """Parse and validate a model mapping from JSON (or YAML for .yaml/.yml files)."""
+    if path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError as e:
+            raise ValueError("PyYAML is required for YAML model mappings") from e
+        data = yaml.safe_load(text)
+    else:
+        data = json.loads(text)
+    if not isinstance(data, dict):
+        raise ValueError("model mapping must be an object of keyword -> route")
+    return {
+        str(keyword): ModelRoute.model_validate(route).model_dump()
+        for keyword, route in data.items()
+    }
+
+
+# Key in request metadata where the routing decision of the first toggle filter is
+# memoized, so the other toggle filter in the same request doesn't route again.
+ROUTING_METADATA_KEY = "model_routing"
+
+
+class ModelRouter:
+    """Model routing engine shared by the search and think toggle filters.
+
+    Open WebUI loads every function from a single file, so this class is kept
+    identical in search.py and think.py. The mapping is compiled once into a trie of
+    normalized keywords, and resolved routes are cached per toggle combination.
+    """
+
+    # Variants tried in order when health-aware routing finds the preferred one degraded
+    FALLBACK_VARIANTS = {
+        "think_search": ("think_search", "think", "search", "base"),
+        "search": ("search", "base"),
+        "think": ("think", "base"),
+        "base": ("base",),
+    }
+
+    def __init__(self, model_mapping: Dict[str, Dict[str, Any]]):
+        self.model_mapping = model_mapping
+        self._keyword_trie: Dict[str, Any] = {}
+        for order, keyword in enumerate(model_mapping.keys()):
+            node = self._keyword_trie
+            for char in self._normalize(keyword):
+                node = node.setdefault(char, {})
+            # "" marks the end of a keyword; earlier keys win ties like the mapping order
+            node.setdefault("", (keyword, order))
+        self.candidates = functools.lru_cache(maxsize=1024)(self._candidates)
+
+    @staticmethod
+    def _normalize(name: str) -> str:
+        return name.lower().replace("-", "").replace(".", "")
+
+    def detect_model_keyword(self, model_name: str) -> Optional[str]:
+        """Detect which keyword the current model contains, preferring the longest match"""
+        normalized_model = self._normalize(model_name)
+        best = None  # (length, -order, keyword)
+
+        for start in range(len(normalized_model)):
+            node = self._keyword_trie
+            for pos in range(start, len(normalized_model)):
+                node = node.get(normalized_model[pos])
+                if node is None:
+                    break
+                if "" in node:
+                    keyword, order = node[""]
+                    candidate = (pos - start + 1, -order, keyword)
+                    if best is None or candidate > best:
+                        best = candidate
+
+        return best[2] if best else None
+
+    def _candidates(
+        self, current_model: str, has_search: bool, has_think: bool
+    ) -> Tuple[Optional[str], Tuple[str, ...]]:
+        """Resolve (keyword, target models) for a model and toggle combination. The
+        first target is the preferred one, the rest are fallbacks in order."""
+        keyword = self.detect_model_keyword(current_model)
+        if not keyword or keyword not in self.model_mapping:
+            return keyword, (current_model,)
+
+        # Determine which variant to use
+        if has_think and has_search:
+            variant = "think_search"
+        elif has_search:
+            variant = "search"
+        elif has_think:
+            variant = "think"
+        else:
+            variant = "base"
+
+        route = self.model_mapping[keyword]
+        # Only update if target model is not None
+        if route.get(variant) is None:
+            return keyword, (current_model,)
+
+        targets = []
+        for name in self.FALLBACK_VARIANTS[variant]:
+            target = route.get(name)
+            if target is None:
+                continue
+            if route.get("suffix"):
+                target = self._apply_suffix(current_model, target)
+            if target not in targets:
+                targets.append(target)
+        return keyword, tuple(targets)
+
+    def resolve(
+        self, current_model: str, has_search: bool, has_think: bool
+    ) -> Tuple[Optional[str], str]:
+        """Resolve (keyword, preferred target model) for a model and toggle combination."""
+        keyword, targets = self.candidates(current_model, has_search, has_think)
+        return keyword, targets[0]
+
+    def _apply_suffix(self, current_model: str, suffix: Optional[str]) -> str:
+        """Append suffix when needed while preventing duplicates"""
+        if not suffix:
+            return current_model
+        if current_model.endswith(suffix):
+            return current_model
+        return f"{current_model}{suffix}"
+
+    def route(
+        self,
+        body: dict,
+        has_search: bool,
+        has_think: bool,
+        is_healthy: Optional[Callable[[str], bool]] = None,
+    ) -> Optional[str]:
+        """Rewrite body["model"] for the active toggles and return the matched keyword.
+
+        With `is_healthy`, the first healthy target (preferred, then fallbacks) is
+        used. The decision is memoized in the request metadata (if the body has any);
+        if another toggle filter already routed this request for the same toggles, it
+        is reused as-is.
+        """
+        metadata = body.get("metadata")
+        if not isinstance(metadata, dict):
+            metadata = None
+        toggles = [has_search, has_think]
+        memo = metadata.get(ROUTING_METADATA_KEY) if metadata is not None else None
+        if (
+            isinstance(memo, dict)
+            and memo.get("toggles") == toggles
+            and memo.get("target") == body.get("model")
+        ):
+            return memo.get("keyword")
+
+        current_model = body.get("model", "")
+        keyword, targets = self.candidates(current_model, has_search, has_think)
+        target = targets[0]
+        if is_healthy is not None:
+            target = next((t for t in targets if is_healthy(t)), targets[0])
+        body["model"] = target
+        if metadata is None:
+            return keyword
+        metadata[ROUTING_METADATA_KEY] = {
+            "source": current_model,
+            "target": target,
+            "keyword": keyword,
+            "toggles": toggles,
+            "fallback": target != targets[0],
+        }
+        return keyword
+
+
+class ModelHealth:
+    """Rolling latency and error statistics per target model.
+
+    Samples come from inlet -> outlet timestamps of each request; errors only from
+    outlet bodies that carry one. Outlet filters only run when the web UI reports a
+    completed chat, so requests that never reach the outlet (API clients, closed tabs)
+    are dropped after the timeout without recording a sample.
+
+    Samples older than `max_age` seconds are ignored. A degraded model gets no traffic
+    and so no new samples; aging its old ones out is what lets it be tried again.
+    """
+
+    def __init__(self, window: int, max_age: float = 0.0):
+        self.window = window
+        self.max_age = max_age
+        # model -> (finish time, latency, ok), oldest first
+        self._samples: Dict[str, Deque[Tuple[float, float, bool]]] = {}
+        # (chat_id, message_id) -> (model, start time), oldest first
+        self._pending: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict()
+
+    def start(self, key: Tuple[str, str], model: str) -> None:
+        self._pending[key] = (model, time.monotonic())
+        self._pending.move_to_end(key)
+
+    def finish(self, key: Tuple[str, str], ok: bool = True) -> None:
+        pending = self._pending.pop(key, None)
+        if pending is not None:
+            model, started = pending
+            self.record(model, time.monotonic() - started, ok)
+
+    def expire(self, timeout: float, max_pending: int = 10000) -> None:
+        now = time.monotonic()
+        while self._pending:
+            key, (_, started) = next(iter(self._pending.items()))
+            if now - started < timeout and len(self._pending) <= max_pending:
+                break
+            del self._pending[key]
+
+    def record(self, model: str, latency: float, ok: bool) -> None:
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = self._samples[model] = deque(maxlen=self.window)
+        samples.append((time.monotonic(), latency, ok))
+
+    def stats(self, model: str) -> Optional[Dict[str, float]]:
+        samples = self._samples.get(model)
+        if samples and self.max_age:
+            cutoff = time.monotonic() - self.max_age
+            while samples and samples[0][0] < cutoff:
+                samples.popleft()
+        if not samples:
+            return None
+        latencies = sorted(latency for _, latency, ok in samples if ok)
+        errors = sum(1 for _, _, ok in samples if not ok)
+
+        def percentile(q: float) -> float:
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+        return {
+            "samples": len(samples),
+            "p50": percentile(0.5),
+            "p95": percentile(0.95),
+            "error_rate": errors / len(samples),
+        }
+
+
+class RoutingLog:
+    """Leveled, sampled structured logging for routing decisions.
+
+    Rewrite events are logged for a sampled fraction of requests only. Every rewrite
+    is counted per (source, target) pair, and the counts are logged as one event
+    once per flush interval, so routing stays observable without per-request I/O.
+    """
+
+    LEVELS = {
+        "debug": logging.DEBUG,
+        "info": logging.INFO,
+        "warning": logging.WARNING,
+        "error": logging.ERROR,
+    }
+
+    def __init__(self, name: str):
+        self.name = name
+        self.logger = logging.getLogger(name)
+        self.level = logging.INFO
+        self.sample_rate = 0.0
+        self.flush_interval = 60.0
+        self.counts: Dict[Tuple[str, str], int] = {}
+        self._flushed_at = time.monotonic()
+
+    def configure(self, level: str, sample_rate: float, flush_interval: float) -> None:
+        self.level = self.LEVELS.get(level, logging.INFO)
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+
+    def event(self, level: int, event: str, **fields: Any) -> None:
+        if level < self.level or not self.logger.isEnabledFor(level):
+            return
+        record = {"filter": self.name, "event": event, **fields}
+        self.logger.log(
+            level, json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        )
+
+    def rewrite(self, source: str, target: str, keyword: Optional[str], fallback: bool) -> None:
+        if self.flush_interval > 0:
+            pair = (source, target)
+            self.counts[pair] = self.counts.get(pair, 0) + 1
+            now = time.monotonic()
+            if now - self._flushed_at >= self.flush_interval:
+                self.flush(now)
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            self.event(
+                logging.INFO,
+                "rewrite",
+                source=source,
+                target=target,
+                keyword=keyword,
+                fallback=fallback,
+            )
+
+    def flush(self, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        if self.counts:
+            counts, self.counts = self.counts, {}
+            self.event(
+                logging.INFO,
+                "rewrite_counts",
+                interval=round(now - self._flushed_at, 1),
+                counts=[
+                    {"source": source, "target": target, "count": count}
+                    for (source, target), count in sorted(
+                        counts.items(), key=lambda item: -item[1]
+                    )
+                ],
+            )
+        self._flushed_at = now
 
 
 class Filter:
     class Valves(BaseModel):
         priority: int = Field(default=100, description="priority")
-        pass
+        model_mapping: str = Field(
+            default="",
+            description="model mapping as inline JSON, or a path to a JSON/YAML file (keyword -> {base, search, think, think_search, suffix}). files are hot-reloaded when they change. empty uses the built-in mapping. point the search and think filters at the same file to keep them consistent.",
+        )
+        mapping_reload_interval: float = Field(
+            default=2.0,
+            ge=0.0,
+            description="minimum seconds between checks of the model mapping file for changes",
+        )
+        health_routing: bool = Field(
+            default=False,
+            description="track latency and errors per target model and fall back to the next variant in the mapping (e.g. think_search -> think -> search -> base) while the preferred one is degraded",
+        )
+        health_window: int = Field(
+            default=50,
+            ge=1,
+            description="number of recent requests per target model used for health statistics",
+        )
+        health_window_seconds: float = Field(
+            default=300.0,
+            ge=0.0,
+            description="samples older than this many seconds are ignored, so a degraded target model is tried again once its failures age out. 0 keeps samples until the request window pushes them out.",
+        )
+        health_min_samples: int = Field(
+            default=5,
+            ge=1,
+            description="minimum samples before a target model can be considered degraded",
+        )
+        fallback_p95_latency: float = Field(
+            default=0.0,
+            ge=0.0,
+            description="fall back when a target model's p95 latency (seconds, request to completion) exceeds this. 0 disables the latency check.",
+        )
+        fallback_error_rate: float = Field(
+            default=0.5,
+            ge=0.0,
+            le=1.0,
+            description="fall back when a target model's error rate reaches this",
+        )
+        log_level: Literal["debug", "info", "warning", "error"] = Field(
+            default="info",
+            description="minimum level for routing log events",
+        )
+        rewrite_log_sample_rate: float = Field(
+            default=0.0,
+            ge=0.0,
+            le=1.0,
+            description="fraction of requests whose model rewrite is logged individually",
+        )
+        rewrite_log_flush_interval: float = Field(
+            default=60.0,
+            ge=0.0,
+            description="seconds between aggregated (source -> target) rewrite count log events. 0 disables aggregation.",
+        )
+        health_timeout: float = Field(
+            default=600.0,
+            gt=0.0,
+            description="seconds after which a request that never reached the outlet is forgotten (not counted as a sample)",
+        )
 
     def __init__(self):
         self.valves = self.Valves()
         self.toggle = True
-        # Model mapping based on README.md
-        self.model_mapping = {
-            "deepseek": {
-                "base": "",
-                "search": None,
-                "think": "-thinking",
-                "think_search": None,
-                "suffix": True,
-            },
-            "gemini-2.5-flash": {
-                "base": "gemini-2.5-flash",
-                "search": "gemini-2.5-flash-search",
-                "think": "gemini-2.5-flash-thinking",
-                "think_search": "gemini-2.5-flash-search",
-            },
-            "gemini-2.5-pro": {
-                "base": "gemini-2.5-pro",
-                "search": "gemini-2.5-pro-search-show",
-                "think": "gemini-2.5-pro-thinking",
-                "think_search": "gemini-2.5-pro-search-show-thinking",
-            },
-            "gemini": {
-                "base": "-preview",
-                "search": "-search-show",
-                "think": "-thinking",
-                "think_search": "-search-show-thinking",
-                "suffix": True,
-            },
-            "doubao-seed": {
-                "base": "",
-                "search": None,
-                "think": "-thinking",
-                "think_search": None,
-                "suffix": True,
-            },
-            "claude": {
-                "base": "",
-                "search": None,
-                "think": "-thinking",
-                "think_search": None,
-                "suffix": True,
-            },
-            "qwen": {
-                "base": "",
-                "search": None,
-                "think": "-thinking",
-                "think_search": None,
-                "suffix": True,
-            },
-            "gpt": {
-                "base": "gpt-5",
-                "search": None,
-                "think": "gpt-5-high",
-                "think_search": None,
-            }
-        }
+        self._router: Optional[ModelRouter] = None
+        # (valve value, file mtime/size, content hash) the current router was built from
+        self._router_source: Optional[str] = None
+        self._router_file_stat: Optional[Tuple[int, int]] = None
+        self._router_hash: Optional[str] = None
+        self._router_checked_at = 0.0
+        self._health = ModelHealth(
+            self.valves.health_window, self.valves.health_window_seconds
+        )
+        self._routing_log = RoutingLog("search.py")
+        # Optional injectable stats source: model -> {"samples", "p50", "p95",
+        # "error_rate"}; replaces the built-in inlet/outlet tracking when set.
+        self.stats_source: Optional[Callable[[str], Optional[Dict[str, float]]]] = None
         self.icon = """data:image/svg+xml;base64,PHN2ZyB4bWxucz0iaHR0cDovL3d3dy53My5vcmcvMjAwMC9zdmciIGZpbGw9Im5vbmUiIHZpZXdCb3g9IjAgMCAyNCAyNCIgc3Ryb2tlLXdpZHRoPSIxLjUiIHN0cm9rZT0iY3VycmVudENvbG9yIj4KICA8cGF0aCBzdHJva2UtbGluZWNhcD0icm91bmQiIHN0cm9rZS1saW5lam9pbj0icm91bmQiIGQ9Ik0yMSAyMWwtNS4xOTctNS4xOTdtLjAwMS0uMDAxYTguNDE4IDguNDE4IDAgMSAwLTEuNDE1IDEuNDE0bDUuMTk2IDUuMTk2eiIgLz4KPC9zdmc+Cg=="""
         pass
 
+    def get_router(self) -> ModelRouter:
+        """Get the routing engine, rebuilding it when the mapping valve or file changes.
+
+        A new router is fully compiled before it replaces the current one in a single
+        assignment, so in-flight requests never see a half-built table. An invalid
+        mapping keeps the previous router.
+        """
+        source = self.valves.model_mapping.strip()
+        router = self._router
+        now = time.monotonic()
+        if (
+            router is not None
+            and source == self._router_source
+            and (
+                not source
+                or source.startswith("{")
+                or now - self._router_checked_at < self.valves.mapping_reload_interval
+            )
+        ):
+            return router
+        self._router_checked_at = now
+
+        try:
+            if not source:
+                text, path, file_stat = "", "", None
+            elif source.startswith("{"):
+                text, path, file_stat = source, "", None
+            else:
+                path = os.path.expanduser(source)
+                stat = os.stat(path)
+                file_stat = (stat.st_mtime_ns, stat.st_size)
+                if (
+                    router is not None
+                    and source == self._router_source
+                    and file_stat == self._router_file_stat
+                ):
+                    return router
+                with open(path, encoding="utf-8") as f:
+                    text = f.read()
+
+            content_hash = hashlib.sha256(text.encode()).hexdigest()
+            if router is None or content_hash != self._router_hash:
+                mapping = parse_model_mapping(text, path) if text else DEFAULT_MODEL_MAPPING
+                router = ModelRouter(mapping)
+                self._routing_log.event(
+                    logging.INFO, "mapping_loaded", entries=len(mapping), path=path
+                )
+            self._router = router
+            self._router_source = source
+            self._router_file_stat = file_stat
+            self._router_hash = content_hash
+        except Exception as e:
+            self._routing_log.event(
+                logging.WARNING, "mapping_invalid", error=str(e), source=source[:200]
+            )
+            if router is None:
+                router = self._router = ModelRouter(DEFAULT_MODEL_MAPPING)
+            # Don't re-parse a broken inline mapping on every request; files are
+            # checked again after mapping_reload_interval
+            self._router_source = source
+        return router
+
     def detect_model_keyword(self, model_name: str) -> Optional[str]:
         """Detect which keyword the current model contains, preferring the longest match"""
-        normalized_model = model_name.lower().replace("-", "").replace(".", "")
-        best_match = None
-        best_length = -1
+        return self.get_router().detect_model_keyword(model_name)
 
-        for keyword in self.model_mapping.keys():
-            normalized_keyword = keyword.replace("-", "").replace(".", "")
-            if normalized_keyword in normalized_model and len(normalized_keyword) > best_length:
-                best_match = keyword
-                best_length = len(normalized_keyword)
+    def get_model_stats(self, model: str) -> Optional[Dict[str, float]]:
+        if self.stats_source is not None:
+            return self.stats_source(model)
+        return self._health.stats(model)
 
-        return best_match
+    def is_model_healthy(self, model: str) -> bool:
+        stats = self.get_model_stats(model)
+        if not stats or stats.get("samples", 0) < self.valves.health_min_samples:
+            return True
+        if stats.get("error_rate", 0.0) >= self.valves.fallback_error_rate:
+            return False
+        latency_limit = self.valves.fallback_p95_latency
+        return not (latency_limit and stats.get("p95", 0.0) > latency_limit)
 
-    def _apply_suffix(self, current_model: str, suffix: Optional[str]) -> str:
-        """Append suffix when needed while preventing duplicates"""
-        if not suffix:
-            return current_model
-        if current_model.endswith(suffix):
-            return current_model
-        return f"{current_model}{suffix}"
+    @staticmethod
+    def _request_key(chat_id: Any, message_id: Any) -> Optional[Tuple[str, str]]:
+        if not chat_id or not message_id:
+            return None
+        return (str(chat_id), str(message_id))
 
     async def inlet(
         self, body: dict, __event_emitter__, __user__: Optional[dict] = None
@@ -107,30 +571,44 @@ class Filter:
         has_search = "search" in filter_ids
         has_think = "think" in filter_ids
 
-        # Detect current model keyword
-        current_model = body.get("model", "")
-        keyword = self.detect_model_keyword(current_model)
+        # Rewrite the model for the active toggles (once per request across filters)
+        health_routing = self.valves.health_routing
+        if health_routing and (
+            self._health.window != self.valves.health_window
+            or self._health.max_age != self.valves.health_window_seconds
+        ):
+            self._health = ModelHealth(
+                self.valves.health_window, self.valves.health_window_seconds
+            )
+        source_model = body.get("model", "")
+        keyword = self.get_router().route(
+            body,
+            has_search,
+            has_think,
+            is_healthy=self.is_model_healthy if health_routing else None,
+        )
 
-        if keyword and keyword in self.model_mapping:
-            # Determine which variant to use
-            if has_think and has_search:
-                target_model = self.model_mapping[keyword]["think_search"]
-            elif has_search:
-                target_model = self.model_mapping[keyword]["search"]
-            elif has_think:
-                target_model = self.model_mapping[keyword]["think"]
-            else:
-                target_model = self.model_mapping[keyword]["base"]
+        if health_routing:
+            metadata = body.get("metadata") or {}
+            self._health.expire(self.valves.health_timeout)
+            key = self._request_key(metadata.get("chat_id"), metadata.get("message_id"))
+            if key:
+                self._health.start(key, body["model"])
 
-            # Only update if target model is not None
-            if target_model is not None:
-                if self.model_mapping[keyword].get("suffix"):
-                    body["model"] = self._apply_suffix(current_model, target_model)
-                else:
-                    body["model"] = target_model
+        routing_log = self._routing_log
+        routing_log.configure(
+            self.valves.log_level,
+            self.valves.rewrite_log_sample_rate,
+            self.valves.rewrite_log_flush_interval,
+        )
+        routing = (body.get("metadata") or {}).get(ROUTING_METADATA_KEY) or {}
+        routing_log.rewrite(
+            routing.get("source", source_model),
+            body["model"],
+            keyword,
+            routing.get("fallback", False),
+        )
 
-        print("search.py----rewrite to "+body["model"])
-        
         if not has_think and has_search:
             await __event_emitter__(
                 {
@@ -144,3 +622,12 @@ class Filter:
             )
 
         return body
+
+    async def outlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
+        if self.valves.health_routing:
+            key = self._request_key(body.get("chat_id"), body.get("id"))
+            if key:
+                messages = body.get("messages") or []
+                failed = bool(messages and messages[-1].get("error"))
+                self._health.finish(key, ok=not failed)
+        return body